@@ -0,0 +1,104 @@
+import os
+import json
+import math
+import pygame
+
+# every tile of a set packed into one sprite sheet per scale, atlas.png at
+# the tiles' own size and atlas-<scale>.png for upscaled copies, with
+# atlas.json holding the tile rects at scale 1
+ATLAS_INDEX = "atlas.json"
+
+def sheet_name(scale):
+    return "atlas.png" if scale == 1 else f"atlas-{scale}.png"
+
+def save_atlas(tile_dir, images, scaled = None):
+    # images are the tiles at scale 1, scaled maps more scales to the same
+    # tiles that many times bigger
+    sheets = {1: images}
+    sheets.update(scaled or {})
+    tile_width, tile_height = images[0].get_size() if images else (0, 0)
+    columns = max(1, math.ceil(math.sqrt(len(images))))
+    rows = max(1, math.ceil(len(images) / columns))
+    rects = [((i % columns) * tile_width, (i // columns) * tile_height, tile_width, tile_height)
+             for i in range(len(images))]
+    for scale, tiles in sheets.items():
+        if not tiles:
+            # an empty set has no sheet to write
+            continue
+        sheet = pygame.Surface((columns * tile_width * scale, rows * tile_height * scale),
+                               pygame.SRCALPHA)
+        for (x, y, _, _), img in zip(rects, tiles):
+            sheet.blit(img, (x * scale, y * scale))
+        pygame.image.save(sheet, os.path.join(tile_dir, sheet_name(scale)))
+    with open(os.path.join(tile_dir, ATLAS_INDEX), "w") as file:
+        json.dump({"scales": sorted(sheets), "rects": rects}, file)
+
+def atlas_scales(tile_dir):
+    path = os.path.join(tile_dir, ATLAS_INDEX)
+    if not os.path.exists(path):
+        return []
+    with open(path) as file:
+        return json.load(file)["scales"]
+
+def load_atlas(tile_dir, scale = None):
+    # the tiles as subsurfaces of one sheet, the biggest one by default
+    with open(os.path.join(tile_dir, ATLAS_INDEX)) as file:
+        index = json.load(file)
+    if not index["rects"]:
+        return []
+    if scale is None:
+        scale = max(index["scales"])
+    if scale not in index["scales"]:
+        raise ValueError(f"{tile_dir} has no atlas at scale {scale}")
+    sheet = pygame.image.load(os.path.join(tile_dir, sheet_name(scale)))
+    return [sheet.subsurface((x * scale, y * scale, w * scale, h * scale))
+            for x, y, w, h in index["rects"]]
+
+def select_atlas(tile_dir, images, kept):
+    # keeps the tiles kept lists (old ids) in that order, at every scale,
+    # a set of one png per tile is turned into an atlas on the way
+    scales = atlas_scales(tile_dir)
+    if not scales:
+        paths = [os.path.join(tile_dir, image) for image in images]
+        if not all(os.path.exists(path) for path in paths):
+            # hand written set without images, nothing to renumber
+            return
+        scales = [1]
+    sheets = {}
+    for scale in scales:
+        if os.path.exists(os.path.join(tile_dir, ATLAS_INDEX)):
+            tiles = load_atlas(tile_dir, scale)
+        else:
+            tiles = [pygame.image.load(path) for path in paths]
+        sheets[scale] = [tiles[i].copy() for i in kept]
+    for image in images:
+        path = os.path.join(tile_dir, image)
+        if os.path.exists(path):
+            os.remove(path)
+    native = sheets.pop(1)
+    save_atlas(tile_dir, native, sheets)
+
+def load_tile_images(tile_dir, tileset, source = None, source_scale = 1, tile_size = 3,
+                     scale = None):
+    if source:
+        if any(x < 0 for x, _ in tileset.positions):
+            raise ValueError(f"{tile_dir} has tiles that aren't in the source image, "
+                             f"like rotated or mirrored ones")
+        # cut from a bigger version of the source image, like scarf-hq.png
+        img = pygame.image.load(source)
+        size = tile_size * source_scale
+        images = [img.subsurface((x * source_scale, y * source_scale, size, size))
+                  for x, y in tileset.positions]
+    elif atlas_scales(tile_dir):
+        with open(os.path.join(tile_dir, ATLAS_INDEX)) as file:
+            rects = json.load(file)["rects"]
+        tile_size = rects[0][2] if rects else tile_size
+        images = load_atlas(tile_dir, scale)
+    else:
+        # older sets, one png per tile
+        images = [pygame.image.load(os.path.join(tile_dir, image)) for image in tileset.images]
+    if tileset.model == "overlap":
+        # patterns sit one pixel apart, a cell shows the top left pixel of its own
+        images = [img.subsurface((0, 0, img.get_width() // tile_size,
+                                  img.get_height() // tile_size)) for img in images]
+    return images
@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import json
+import time
+import shutil
+import argparse
+import platform
+import subprocess
+import tempfile
+from solver import Solver, Tileset
+from farm import generate
+
+WORKLOADS = ["gen_tiles", "solve", "collapse", "frames", "startup"]
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        prog = "./bench.py",
+        description = "Time the tile generator, the solver and the live view "
+                      "with fixed seeds and write the numbers as json.")
+    parser.add_argument("workloads", nargs = "*",
+                        help = f"any of {', '.join(WORKLOADS)}, all by default")
+    parser.add_argument("--out", default = "bench.json", help = "json results file")
+    parser.add_argument("--seeds", type = int, default = 3,
+                        help = "seeds 0 .. seeds - 1 are solved for every size")
+    parser.add_argument("--sizes", type = int, nargs = "+", default = [10, 20, 40],
+                        help = "square grid sizes for the solve workload")
+    parser.add_argument("--tile-dirs", nargs = "+", default = ["scarf", "simple-tiles"])
+    parser.add_argument("--image", default = "scarf.png",
+                        help = "image gen_tiles is timed on, repeated to larger sizes")
+    parser.add_argument("--repeats", type = int, nargs = "+", default = [1, 2, 4],
+                        help = "how many times the image is repeated along each side")
+    parser.add_argument("--frames", type = int, default = 200,
+                        help = "solver steps drawn by the frames workload")
+    parser.add_argument("--runs", type = int, default = 5,
+                        help = "fresh processes started by the startup workload")
+    args = parser.parse_args(argv)
+    for name in args.workloads:
+        if name not in WORKLOADS:
+            parser.error(f"unknown workload {name}")
+    return args
+
+def summary(times):
+    # times in seconds, reported in milliseconds
+    times = sorted(times)
+    if not times:
+        return {"count": 0}
+    return {
+        "count": len(times),
+        "mean_ms": sum(times) / len(times) * 1000,
+        "p50_ms": times[len(times) // 2] * 1000,
+        "p95_ms": times[min(int(len(times) * 0.95), len(times) - 1)] * 1000,
+        "max_ms": times[-1] * 1000
+    }
+
+def bench_gen_tiles(image, repeats):
+    import numpy
+    import pygame
+    import gen_tiles
+    pygame.init()
+    pixels = pygame.surfarray.array3d(pygame.image.load(image))
+    results = []
+    cwd = os.getcwd()
+    tmp = tempfile.mkdtemp()
+    try:
+        # gen_tiles writes its tile directory next to where it runs
+        os.chdir(tmp)
+        for n in repeats:
+            img_path = f"bench-{n}.png"
+            pygame.image.save(pygame.surfarray.make_surface(numpy.tile(pixels, (n, n, 1))),
+                              img_path)
+            app = gen_tiles.App(img_path)
+            app.img = pygame.image.load(img_path)
+            os.makedirs(app.get_dir(), exist_ok = True)
+            start = time.perf_counter()
+            app.gen_tiles()
+            elapsed = time.perf_counter() - start
+            width, height = app.img.get_size()
+            results.append({"width": width, "height": height, "tiles": len(app.tiles),
+                            "time": elapsed})
+            print(f"gen_tiles {width}x{height}: {len(app.tiles)} tiles in {elapsed:.3f}s")
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmp, True)
+    return results
+
+def bench_solve(tile_dirs, sizes, seeds):
+    results = []
+    for tile_dir in tile_dirs:
+        tileset = Tileset.load(tile_dir)
+        for size in sizes:
+            runs = [generate(tileset, size, size, seed) for seed in range(seeds)]
+            record = {
+                "tile_dir": tile_dir,
+                "size": size,
+                "retries": sum(run["retries"] for run in runs),
+                "restarts": sum(run["restarts"] for run in runs),
+                "solve": summary([run["time"] for run in runs])
+            }
+            results.append(record)
+            print(f"solve {tile_dir} {size}x{size}: "
+                  f"{record['solve']['mean_ms']:.1f}ms mean over {seeds} seeds, "
+                  f"{record['retries']} row retries, {record['restarts']} restarts")
+    return results
+
+def bench_collapse(tile_dirs, size, seed = 0):
+    # cost of a single collapse() and how many cells its propagation changed
+    results = []
+    for tile_dir in tile_dirs:
+        solver = Solver(Tileset.load(tile_dir), size, size, seed)
+        solver.verbose = False
+        solver.max_retries = 50
+        solver.track_dirty()
+        solver.take_dirty()
+        times = []
+        touched = []
+        while not solver.done:
+            start = time.perf_counter()
+            solver.collapse()
+            times.append(time.perf_counter() - start)
+            touched.append(len(solver.take_dirty()))
+        record = {
+            "tile_dir": tile_dir,
+            "size": size,
+            "collapse": summary(times),
+            "cells_touched_mean": sum(touched) / len(touched),
+            "cells_touched_max": max(touched)
+        }
+        results.append(record)
+        print(f"collapse {tile_dir} {size}x{size}: "
+              f"{record['collapse']['mean_ms'] * 1000:.1f}us mean, "
+              f"{record['cells_touched_mean']:.1f} cells touched on average")
+    return results
+
+def bench_frames(tile_dir, frames, seed = 0):
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    import pygame
+    import wfc
+    pygame.init()
+    game = wfc.MyGame(tile_dir)
+    game.base_win = pygame.display.set_mode((400, 800))
+    game.win = pygame.Surface((400, 800))
+    game.font = pygame.font.Font(None, 24)
+    # drive the solver from here, one step per frame
+    grid = wfc.Grid(game, seed = seed, start = False)
+    worker = grid.worker
+    worker.solver.verbose = False
+    full = []
+    dirty = []
+    fade = []
+    for _ in range(frames):
+        worker.step()
+        for snapshot in worker.take_snapshots():
+            grid.apply(snapshot)
+        start = time.perf_counter()
+        grid.draw_dirty()
+        dirty.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        game.win.fill((0, 0, 0))
+        grid.draw()
+        full.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        game.fade_to_gray(game.win, 0.5)
+        fade.append(time.perf_counter() - start)
+    pygame.quit()
+    record = {
+        "tile_dir": tile_dir,
+        "frames": frames,
+        "draw_dirty": summary(dirty),
+        "draw_full": summary(full),
+        "fade": summary(fade)
+    }
+    print(f"frames {tile_dir}: dirty {record['draw_dirty']['mean_ms']:.2f}ms, "
+          f"full {record['draw_full']['mean_ms']:.2f}ms, "
+          f"fade {record['fade']['mean_ms']:.2f}ms mean")
+    return [record]
+
+# imports what a headless user needs and builds a solver, prints the seconds
+# that took from inside the process
+HEADLESS = """
+import time
+start = time.perf_counter()
+from solver import Solver, Tileset
+solver = Solver(Tileset.load({tile_dir!r}))
+print(time.perf_counter() - start)
+"""
+
+def bench_startup(tile_dir, runs):
+    # wall time of fresh processes, the live view until it has shown its
+    # first frame and a headless solver until it is ready to collapse
+    env = dict(os.environ, SDL_VIDEODRIVER = "dummy", SDL_AUDIODRIVER = "dummy")
+    first_frame = []
+    headless = []
+    headless_ready = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        process = subprocess.Popen([sys.executable, "wfc.py", tile_dir], env = env,
+                                   stdout = subprocess.PIPE, text = True)
+        for line in process.stdout:
+            if line.startswith("First frame"):
+                first_frame.append(time.perf_counter() - start)
+                break
+        process.kill()
+        process.wait()
+        start = time.perf_counter()
+        output = subprocess.run([sys.executable, "-c", HEADLESS.format(tile_dir = tile_dir)],
+                                env = env, stdout = subprocess.PIPE, text = True,
+                                check = True).stdout
+        headless.append(time.perf_counter() - start)
+        headless_ready.append(float(output))
+    record = {
+        "tile_dir": tile_dir,
+        "first_frame": summary(first_frame),
+        "headless_process": summary(headless),
+        "headless_import_to_ready": summary(headless_ready)
+    }
+    print(f"startup {tile_dir}: first frame {record['first_frame']['mean_ms']:.0f}ms, "
+          f"headless process {record['headless_process']['mean_ms']:.0f}ms, "
+          f"import to solver ready {record['headless_import_to_ready']['mean_ms']:.1f}ms mean")
+    return [record]
+
+def main(argv):
+    args = parse_args(argv)
+    workloads = args.workloads or WORKLOADS
+    results = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "workloads": {}
+    }
+    for name in workloads:
+        if name == "gen_tiles":
+            records = bench_gen_tiles(args.image, args.repeats)
+        elif name == "solve":
+            records = bench_solve(args.tile_dirs, args.sizes, args.seeds)
+        elif name == "collapse":
+            records = bench_collapse(args.tile_dirs, max(args.sizes))
+        elif name == "frames":
+            records = bench_frames("scarf", args.frames)
+        else:
+            records = bench_startup("scarf", args.runs)
+        results["workloads"][name] = records
+    with open(args.out, "w") as file:
+        json.dump(results, file, indent = 4)
+    print(f"Results written to {args.out}")
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
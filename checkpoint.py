@@ -0,0 +1,84 @@
+import os
+import sys
+import time
+import queue
+import threading
+from solver import Solver
+
+def write_atomic(path, data):
+    # written aside, synced and moved over, a crash leaves the last snapshot
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as file:
+        file.write(data)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, path)
+
+def load_solver(tileset, path):
+    # the solver saved at path, None if there is no snapshot yet
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as file:
+        return Solver.from_snapshot(tileset, file.read())
+
+def check_path(path):
+    # the directory a checkpoint goes to, None when it exists
+    directory = os.path.dirname(path) or "."
+    if not os.path.isdir(directory):
+        return f"checkpoint directory {directory} doesn't exist"
+    return None
+
+class Checkpointer(threading.Thread):
+
+    # writes solver snapshots to path in the background, the thread that
+    # steps the solver only pays for to_snapshot() every interval seconds
+    def __init__(self, path, interval = 60):
+        super().__init__(daemon = True)
+        self.path = path
+        self.interval = interval
+        self.last = time.perf_counter()
+        self.writes = 0
+        # only the newest snapshot waits to be written
+        self.pending = queue.Queue(maxsize = 1)
+
+    def update(self, solver):
+        if time.perf_counter() - self.last >= self.interval:
+            self.save(solver)
+
+    def save(self, solver):
+        self.last = time.perf_counter()
+        self.put(solver.to_snapshot())
+
+    def put(self, data):
+        while True:
+            try:
+                self.pending.put_nowait(data)
+                return
+            except queue.Full:
+                try:
+                    self.pending.get_nowait()
+                except queue.Empty:
+                    pass
+
+    def run(self):
+        while True:
+            data = self.pending.get()
+            if data is None:
+                return
+            try:
+                write_atomic(self.path, data)
+            except OSError as e:
+                # the next snapshot may get through, the solver carries on
+                print(f"checkpoint not written to {self.path}: {e}", file = sys.stderr)
+                continue
+            self.writes += 1
+
+    def stop(self):
+        # whatever was saved last is written before it returns, a thread that
+        # isn't running has nothing to wait for
+        while self.is_alive():
+            try:
+                self.pending.put(None, timeout = 0.1)
+            except queue.Full:
+                continue
+            self.join()
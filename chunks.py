@@ -0,0 +1,109 @@
+import os
+import json
+import time
+import numpy
+from solver import Solver, settle
+from farm import make_pool, run_task
+
+def chunk_path(out_dir, cx, cy):
+    return os.path.join(out_dir, f"{cx}_{cy}.npy")
+
+def edge_masks(tileset, left = None, bottom = None):
+    # tiles allowed in column 0 next to the right column (bottom up) of the
+    # chunk to the left, and in row 0 above the top row of the chunks below
+    support = tileset.support
+    masks = {}
+    for y, v in enumerate(left or []):
+        masks[(0, y)] = support(1 << v, "right")
+    for x, v in enumerate(bottom or []):
+        masks[(x, 0)] = masks.get((x, 0), tileset.full) & support(1 << v, "up")
+    return masks
+
+def solve_chunk(tileset, cx, cy, width, height, seed, left, bottom, bottom_right, out_dir,
+                max_retries = 50, margin = 4, max_restarts = 100):
+    # left, bottom and bottom_right are the edges of the chunks solved before
+    # this one, None at the border of the world. The chunk is solved margin
+    # cells wider and taller and cut back, so its top row and right column
+    # are known to have room for the chunks that continue from them
+    start = time.perf_counter()
+    solver = Solver(tileset, width + margin, height + margin, f"{seed}:{cx}:{cy}")
+    solver.verbose = False
+    solver.max_retries = max_retries
+    if bottom and bottom_right:
+        bottom = bottom + bottom_right[:margin]
+    masks = edge_masks(tileset, left, bottom)
+    # one row and column of edges, the worklist beats a sweep of every cell
+    solver.constrain(settle(tileset, width + margin, height + margin, masks, bulk = False))
+    while not solver.done:
+        solver.collapse()
+        if solver.restarts > max_restarts:
+            raise RuntimeError(f"chunk {cx}, {cy} doesn't fit its neighbours, try a bigger margin")
+    tiles = numpy.array(solver.tile_grid(), dtype = numpy.int32)[margin:, :width]
+    numpy.save(chunk_path(out_dir, cx, cy), tiles)
+    rows = [solver.row_tiles(row)[:width] for row in solver.rows[:height]]
+    return {
+        "cx": cx,
+        "cy": cy,
+        # what the chunks to the right and above need, bottom up and left to right
+        "right": [row[-1] for row in rows],
+        "top": rows[-1],
+        "retries": solver.retries,
+        "restarts": solver.restarts,
+        "backtracks": solver.backtracks,
+        "time": time.perf_counter() - start
+    }
+
+def generate_world(tileset, chunks_x, chunks_y, width, height, out_dir, seed = 0,
+                   jobs = None, max_retries = 50, margin = 4):
+    # solves chunks_x * chunks_y chunks of width x height cells into out_dir,
+    # yields results as chunks finish. A chunk needs the chunks to its left,
+    # below it and below to the right (its margin overlaps that one), so
+    # chunks with the same cx + 2 * cy never meet and each such wave is
+    # solved in parallel
+    tileset.prepare()
+    os.makedirs(out_dir, exist_ok = True)
+    with open(os.path.join(out_dir, "world.json"), "w") as file:
+        json.dump({
+            "chunks_x": chunks_x,
+            "chunks_y": chunks_y,
+            "chunk_width": width,
+            "chunk_height": height,
+            "seed": seed
+        }, file, indent = 4)
+    # edges of solved chunks until their last user is solved, the only
+    # solved tiles kept in memory
+    rights = {}
+    tops = {}
+    pool = make_pool(jobs, tileset) if jobs != 1 else None
+    try:
+        for wave in range(chunks_x + 2 * chunks_y - 2):
+            tasks = []
+            for cy in range(chunks_y):
+                cx = wave - 2 * cy
+                if cx < 0 or cx >= chunks_x:
+                    continue
+                args = (cx, cy, width, height, seed, rights.pop((cx - 1, cy), None),
+                        tops.pop((cx, cy - 1), None), tops.get((cx + 1, cy - 1)),
+                        out_dir, max_retries, margin)
+                tasks.append((solve_chunk, args))
+            if pool:
+                results = pool.imap_unordered(run_task, tasks)
+            else:
+                results = (function(tileset, *args) for function, args in tasks)
+            for result in results:
+                rights[(result["cx"], result["cy"])] = result["right"]
+                tops[(result["cx"], result["cy"])] = result["top"]
+                yield result
+    finally:
+        if pool:
+            pool.terminate()
+
+def load_world(out_dir):
+    # the whole world as one array, top row first, only for worlds that fit
+    with open(os.path.join(out_dir, "world.json")) as file:
+        world = json.load(file)
+    rows = []
+    for cy in reversed(range(world["chunks_y"])):
+        rows.append(numpy.hstack([numpy.load(chunk_path(out_dir, cx, cy))
+                                  for cx in range(world["chunks_x"])]))
+    return numpy.vstack(rows)
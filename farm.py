@@ -0,0 +1,79 @@
+import time
+import multiprocessing
+from solver import Solver
+
+# the tileset workers solve with, inherited on fork or set once per worker
+_tileset = None
+
+def generate(tileset, width, height, seed, max_retries = 50, heuristic = "size", trail = None):
+    # trail is (max_depth, budget) to backtrack through decisions
+    start = time.perf_counter()
+    solver = Solver(tileset, width, height, seed, heuristic)
+    solver.verbose = False
+    solver.max_retries = max_retries
+    if trail:
+        solver.enable_trail(*trail)
+    solver.solve()
+    return {
+        "seed": seed,
+        "width": solver.width,
+        "height": solver.height,
+        "tiles": solver.tile_grid(),
+        "retries": solver.retries,
+        "restarts": solver.restarts,
+        "backtracks": solver.backtracks,
+        "time": time.perf_counter() - start
+    }
+
+def init_worker(tileset):
+    global _tileset
+    _tileset = tileset
+
+def make_pool(jobs = None, tileset = None):
+    # worker processes for run_task(), forked children share the tileset and
+    # its already built tables copy-on-write, others get a copy each
+    global _tileset
+    _tileset = tileset
+    if "fork" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("fork").Pool(jobs)
+    return multiprocessing.Pool(jobs, init_worker, (tileset,))
+
+def run_task(task):
+    # task is (function, args), called in a worker as function(tileset, *args)
+    function, args = task
+    return function(_tileset, *args)
+
+def farm(tileset, seeds, width, height, jobs = None, max_retries = 50, heuristic = "size",
+         trail = None):
+    # yields results in the order they finish, not in seed order
+    tileset.prepare()
+    tasks = [(generate, (width, height, seed, max_retries, heuristic, trail)) for seed in seeds]
+    with make_pool(jobs, tileset) as pool:
+        for result in pool.imap_unordered(run_task, tasks):
+            yield result
+
+class FarmStats:
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.layouts = 0
+        self.retries = 0
+        self.restarts = 0
+        self.backtracks = 0
+        self.solve_time = 0
+
+    def add(self, result):
+        self.layouts += 1
+        self.retries += result["retries"]
+        self.restarts += result["restarts"]
+        self.backtracks += result["backtracks"]
+        self.solve_time += result["time"]
+
+    def report(self):
+        elapsed = time.perf_counter() - self.start
+        print(f"{self.layouts} layouts in {elapsed:.2f}s "
+              f"({self.solve_time:.2f}s spent solving)")
+        print(f"{self.layouts / elapsed:.2f} layouts/sec, "
+              f"{self.retries / elapsed:.2f} contradictions/sec, "
+              f"{self.restarts / elapsed:.2f} restarts/sec, "
+              f"{self.backtracks / elapsed:.2f} backtracks/sec")
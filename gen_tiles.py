@@ -5,12 +5,52 @@ import pygame
 import os
 import shutil
 import json
+import hashlib
 import numpy
+from numpy.lib.stride_tricks import sliding_window_view
+from solver import Tileset
+from atlas import save_atlas, load_atlas, atlas_scales, select_atlas
+from farm import make_pool
 
 def usage():
-    print("Usage: ./gen_tiles.py image.png tile-size")
+    print("Usage: ./gen_tiles.py image.png tile-size [-o] [-s symmetry] [-u scale [-q hq_image.png]]")
+    print("       ./gen_tiles.py -c tile_dir")
+    print("       ./gen_tiles.py -b tile_dir image.png [image.png ...] [-t tile_size] [-j jobs]")
+    print(" " * 4, "-c prune and compile an existing tiles.json to tiles.bin")
+    print(" " * 4, "-b add images to a tile set, only new or changed ones are read")
+    print(" " * 4, "-o overlapping model, a tile_size pattern at every pixel")
+    print(" " * 4, "-s with -o, also add rotated and mirrored patterns (1, 2, 4 or 8)")
+    print(" " * 4, "-u also write the atlas this many times bigger")
+    print(" " * 4, "-q with -u, cut the bigger tiles from this image instead of scaling")
     print(" " * 4, "-h print this message and exit")
 
+def compile_tiles(tile_dir, tile_desc = None, prune = True, min_kept = 0.5):
+    json_path = os.path.join(tile_dir, "tiles.json")
+    if tile_desc is None:
+        tileset = Tileset.load_json(json_path)
+    else:
+        tileset = Tileset.from_desc(tile_desc)
+    if not prune:
+        tileset.save_compiled(os.path.join(tile_dir, "tiles.bin"))
+        return
+    pruned, groups = tileset.pruned()
+    kept = sum(len(members) for members in groups)
+    if pruned.count == 0 or pruned.count < tileset.count * min_kept:
+        # tiles only seen at the edge of the image have no neighbour on that
+        # side, dropping them cascades through sets that are mostly edges
+        print(f"Warning: pruning would leave {pruned.count} of {tileset.count} tiles, "
+              f"keeping the set unpruned")
+        tileset.save_compiled(os.path.join(tile_dir, "tiles.bin"))
+        return
+    print(f"Pruned {tileset.count - kept} dead tiles, merged {kept - pruned.count} "
+          f"interchangeable ones, {tileset.count} -> {pruned.count} tiles")
+    if pruned.compat != tileset.compat:
+        # tile ids changed, give the atlas and tiles.json the new ones
+        select_atlas(tile_dir, tileset.images, [members[0] for members in groups])
+        with open(json_path, "w") as file:
+            json.dump(pruned.to_desc(), file, indent = 4)
+    pruned.save_compiled(os.path.join(tile_dir, "tiles.bin"))
+
 class Tile:
 
     def __init__(self, img):
@@ -21,83 +61,198 @@ class Tile:
         self.down = set()
         self.x = 0
         self.y = 0
+        self.weight = 1
+
+def pattern_variants(patterns, symmetry = 1):
+    # patterns as (count, y, x, channels), each variant is a rotation or a
+    # mirror image of all of them, in the order symmetry takes them
+    variants = []
+    rotated = patterns
+    for _ in range(4):
+        variants.append(rotated)
+        variants.append(numpy.flip(rotated, axis = 2))
+        rotated = numpy.rot90(rotated, 1, axes = (1, 2))
+    return variants[:symmetry]
 
-    def cmp_img(self, img):
-        # surprisingly the numpy way is slower than brute forcing ==
-        # a = pygame.surfarray.array2d(self.img)
-        # b = pygame.surfarray.array2d(img)
-        # return numpy.array_equal(a, b)
-        width, height = self.img.get_size()
-        for y in range(height):
-            for x in range(width):
-                if self.img.get_at((x, y)) != img.get_at((x, y)):
-                    return False
-        return True
+def overlap_compat(patterns, dx, dy):
+    # compat[a, b] is true when b placed at (dx, dy) from a agrees with a on
+    # every pixel they share, dy grows down like in the image
+    size = patterns.shape[1]
+    a = patterns[:, max(dy, 0):size + min(dy, 0), max(dx, 0):size + min(dx, 0)]
+    b = patterns[:, max(-dy, 0):size + min(-dy, 0), max(-dx, 0):size + min(-dx, 0)]
+    count = len(patterns)
+    # number each distinct overlap once, then compare numbers, not pixels
+    regions = numpy.concatenate([a, b]).reshape(2 * count, -1)
+    _, ids = numpy.unique(regions, axis = 0, return_inverse = True)
+    ids = ids.reshape(-1)
+    return ids[:count, None] == ids[None, count:]
 
 class App:
 
-    def __init__(self, img_path, tile_size = 3):
+    def __init__(self, img_path, tile_size = 3, overlap = False, symmetry = 1, upscale = 1,
+                 hq_path = None):
         self.img_path = img_path
         self.tile_size = tile_size
+        # overlapping model, patterns at every pixel instead of a tile grid
+        self.overlap = overlap
+        self.symmetry = symmetry
+        # a second atlas upscale times bigger, cut from hq_path if given
+        self.upscale = upscale
+        self.hq_path = hq_path
         self.tiles = []
 
     def get_dir(self):
         dir, _ = os.path.splitext(os.path.basename(self.img_path))
         return dir
     
-    def find_tile(self, img):
-        for i, tile in enumerate(self.tiles):
-            if tile.cmp_img(img):
-                return (i, tile)
-        return (0, None)
-    
-    def get_tile(self, x, y):
-        img = self.img.subsurface(x, y, self.tile_size, self.tile_size)
-        i, tile = self.find_tile(img)
-        if tile:
-            return i, tile
-        else:
-            tile = Tile(img)
+    def load_pixels(self):
+        # rows first, so pixels[y, x] is the color at (x, y)
+        pixels = pygame.surfarray.array3d(self.img)
+        if self.img.get_flags() & pygame.SRCALPHA:
+            alpha = pygame.surfarray.array_alpha(self.img)
+            pixels = numpy.dstack((pixels, alpha))
+        return pixels.transpose(1, 0, 2)
+
+    def window_ids(self, pixels):
+        # dedup id of the tile_size window at every pixel position
+        windows = sliding_window_view(pixels, (self.tile_size, self.tile_size), axis = (0, 1))
+        rows, cols = windows.shape[:2]
+        flat = numpy.ascontiguousarray(windows).reshape(rows * cols, -1)
+        raw = flat.tobytes()
+        size = flat.shape[1]
+        index = {}
+        ids = [index.setdefault(raw[i * size:(i + 1) * size], len(index))
+               for i in range(rows * cols)]
+        return numpy.array(ids).reshape(rows, cols)
+
+    def gen_tiles(self):
+        img_width, img_height = self.img.get_size()
+        print(f"Size {img_width}x{img_height}")
+        ts = self.tile_size
+        ids = self.window_ids(self.load_pixels())
+        seen_x, seen_y, left, right, up, down = self.scan(ids)
+        # numbering tiles as first seen
+        uniq, first = numpy.unique(ids[seen_y, seen_x], return_index = True)
+        order = numpy.argsort(first)
+        remap = numpy.full(ids.max() + 1 if ids.size else 0, -1)
+        remap[uniq[order]] = numpy.arange(len(order))
+        ids = remap[ids]
+        for i in first[order]:
+            x = int(seen_x[i])
+            y = int(seen_y[i])
+            tile = Tile(self.img.subsurface(x, y, ts, ts))
             tile.x = x
             tile.y = y
             self.tiles.append(tile)
-            return len(self.tiles) - 1, tile
+        # how often each tile occurs in the image, the solver samples by it
+        counts = numpy.bincount(ids[ids >= 0], minlength = len(self.tiles))
+        for tile, count in zip(self.tiles, counts.tolist()):
+            tile.weight = count
+        for a, b in self.unique_pairs(remap[left], remap[right]):
+            self.tiles[a].right.add(b)
+            self.tiles[b].left.add(a)
+        for a, b in self.unique_pairs(remap[up], remap[down]):
+            self.tiles[a].down.add(b)
+            self.tiles[b].up.add(a)
+        print(f"Made {len(self.tiles)} tiles")
+        self.save()
 
-    def gen_tiles(self):
+    def scan(self, ids):
+        # visit positions like a scan that looks at each tile and then its
+        # left, right, up and down neighbours. Returns the positions seen in
+        # that order and the window ids of the horizontal (left, right) and
+        # vertical (up, down) neighbour pairs it saw
+        ts = self.tile_size
+        rows, cols = ids.shape
+        ys, xs = numpy.mgrid[0:rows - 1, 0:cols - 1]
+        ys = ys.ravel()
+        xs = xs.ravel()
+        has_left = xs >= ts
+        has_right = xs <= cols - 1 - ts
+        has_up = ys >= ts
+        has_down = ys <= rows - 1 - ts
+        seen_x = numpy.stack([xs, xs - ts, xs + ts, xs, xs], axis = 1)
+        seen_y = numpy.stack([ys, ys, ys, ys - ts, ys + ts], axis = 1)
+        valid = numpy.stack([numpy.ones_like(has_left), has_left, has_right,
+                             has_up, has_down], axis = 1)
+        lx, ly = xs[has_left], ys[has_left]
+        rx, ry = xs[has_right], ys[has_right]
+        left = numpy.concatenate([ids[ly, lx - ts], ids[ry, rx]])
+        right = numpy.concatenate([ids[ly, lx], ids[ry, rx + ts]])
+        ux, uy = xs[has_up], ys[has_up]
+        dx, dy = xs[has_down], ys[has_down]
+        up = numpy.concatenate([ids[uy - ts, ux], ids[dy, dx]])
+        down = numpy.concatenate([ids[uy, ux], ids[dy + ts, dx]])
+        return seen_x[valid], seen_y[valid], left, right, up, down
+
+    def gen_patterns(self):
         img_width, img_height = self.img.get_size()
         print(f"Size {img_width}x{img_height}")
-        # for y in range(0, img_height - self.tile_size, self.tile_size):
-        #     for x in range(0, img_width - self.tile_size, self.tile_size):
-        for y in range(0, img_height - self.tile_size):
-            for x in range(0, img_width - self.tile_size):
-                i, tile = self.get_tile(x, y)
-                if x >= self.tile_size:
-                    li, left = self.get_tile(x - self.tile_size, y)
-                    tile.left.add(li)
-                    left.right.add(i)
-                if x <= img_width - 2 * self.tile_size:
-                    ri, right = self.get_tile(x + self.tile_size, y)
-                    tile.right.add(ri)
-                    right.left.add(i)
-                if y >= self.tile_size:
-                    ui, up = self.get_tile(x, y - self.tile_size)
-                    tile.up.add(ui)
-                    up.down.add(i)
-                if y <= img_height - 2 * self.tile_size:
-                    di, down = self.get_tile(x, y + self.tile_size)
-                    tile.down.add(di)
-                    down.up.add(i)
-
-        print(f"Made {len(self.tiles)} tiles")
+        ts = self.tile_size
+        pixels = self.load_pixels()
+        windows = sliding_window_view(pixels, (ts, ts), axis = (0, 1))
+        rows, cols = windows.shape[:2]
+        # (count, y, x, channels), one pattern per pixel, row by row
+        patterns = windows.transpose(0, 1, 3, 4, 2).reshape(rows * cols, ts, ts, -1)
+        patterns = numpy.concatenate(pattern_variants(patterns, self.symmetry))
+        flat = numpy.ascontiguousarray(patterns).reshape(len(patterns), -1)
+        _, first, counts = numpy.unique(flat, axis = 0, return_index = True,
+                                        return_counts = True)
+        # number patterns as first seen, every variant counts towards weight
+        order = numpy.argsort(first)
+        first = first[order]
+        counts = counts[order]
+        patterns = numpy.ascontiguousarray(patterns[first])
+        for i, count in zip(first.tolist(), counts.tolist()):
+            # rotated and mirrored variants aren't anywhere in the image
+            y, x = divmod(i, cols) if i < rows * cols else (-1, -1)
+            tile = Tile(self.pattern_surface(patterns[len(self.tiles)]))
+            tile.x = x
+            tile.y = y
+            tile.weight = count
+            self.tiles.append(tile)
+        # the solver only propagates to direct neighbours, so the overlaps
+        # one pixel away in each direction are the constraints it needs
+        for name, dx, dy in [("left", -1, 0), ("right", 1, 0), ("up", 0, -1), ("down", 0, 1)]:
+            compat = overlap_compat(patterns, dx, dy)
+            for tile, allowed in zip(self.tiles, compat):
+                setattr(tile, name, set(numpy.flatnonzero(allowed).tolist()))
+        print(f"Made {len(self.tiles)} patterns")
         self.save()
 
+    def pattern_surface(self, pattern):
+        # pattern is (y, x, channels), surfaces index pixels as (x, y)
+        pixels = pattern.transpose(1, 0, 2)
+        ts = self.tile_size
+        if pixels.shape[2] == 4:
+            img = pygame.Surface((ts, ts), pygame.SRCALPHA)
+            pygame.surfarray.blit_array(img, pixels[:, :, :3])
+            pygame.surfarray.pixels_alpha(img)[:] = pixels[:, :, 3]
+            return img
+        return pygame.surfarray.make_surface(pixels)
+
+    def unique_pairs(self, a, b):
+        codes = numpy.unique(a * len(self.tiles) + b)
+        return zip((codes // len(self.tiles)).tolist(), (codes % len(self.tiles)).tolist())
+
+    def upscaled_images(self):
+        size = self.tile_size * self.upscale
+        if not self.hq_path:
+            return [pygame.transform.scale(tile.img, (size, size)) for tile in self.tiles]
+        # a hand made bigger version of the image, like scarf-hq.png
+        img = pygame.image.load(self.hq_path)
+        return [img.subsurface((tile.x * self.upscale, tile.y * self.upscale, size, size))
+                if tile.x >= 0 else pygame.transform.scale(tile.img, (size, size))
+                for tile in self.tiles]
+
     def save(self):
+        model = "overlap" if self.overlap else "tiled"
         tiles = []
-        for i, tile in enumerate(self.tiles):
+        for tile in self.tiles:
             info = {
-                "image": f"{i}.png",
                 "x": tile.x,
                 "y": tile.y,
+                "weight": tile.weight,
                 "constraints": {
                     "left": list(tile.left),
                     "right": list(tile.right),
@@ -106,11 +261,12 @@ class App:
                 }
             }
             tiles.append(info)
-            img_path = os.path.join(self.get_dir(), info["image"])
-            pygame.image.save(tile.img, img_path)
+        scaled = {self.upscale: self.upscaled_images()} if self.upscale > 1 else {}
+        save_atlas(self.get_dir(), [tile.img for tile in self.tiles], scaled)
         json_path = os.path.join(self.get_dir(), "tiles.json")
         with open(json_path, "w") as file:
-            json.dump({"tiles":tiles}, file, indent = 4)
+            json.dump({"model":model, "tiles":tiles}, file, indent = 4)
+        compile_tiles(self.get_dir(), {"model":model, "tiles":tiles})
 
     def run(self):
         print(f"Image {self.img_path}")
@@ -118,16 +274,208 @@ class App:
         self.img = pygame.image.load(self.img_path)
         shutil.rmtree(self.get_dir(), True)
         os.makedirs(self.get_dir(), exist_ok=True)
-        self.gen_tiles()
+        if self.overlap:
+            self.gen_patterns()
+        else:
+            self.gen_tiles()
+
+def file_digest(path):
+    with open(path, "rb") as file:
+        return hashlib.sha1(file.read()).hexdigest()
+
+def image_tiles(task):
+    # the tiles of one image keyed by content hash, with where they were
+    # first seen, how often they occur and the neighbour pairs the scan saw.
+    # Runs in a worker, numbering is left to the Builder
+    img_path, tile_size = task
+    app = App(img_path, tile_size)
+    app.img = pygame.image.load(img_path)
+    pixels = app.load_pixels()
+    if pixels.shape[2] == 3:
+        # always with alpha, so a tile hashes the same in every image
+        pixels = numpy.dstack((pixels, numpy.full(pixels.shape[:2], 255, pixels.dtype)))
+    ids = app.window_ids(pixels)
+    seen_x, seen_y, left, right, up, down = app.scan(ids)
+    _, first = numpy.unique(ids[seen_y, seen_x], return_index = True)
+    counts = numpy.bincount(ids.ravel())
+    hashes = {}
+    tiles = []
+    for i in sorted(first.tolist()):
+        x = int(seen_x[i])
+        y = int(seen_y[i])
+        data = numpy.ascontiguousarray(pixels[y:y + tile_size, x:x + tile_size]).tobytes()
+        digest = hashlib.sha1(data).hexdigest()
+        hashes[int(ids[y, x])] = digest
+        tiles.append((digest, x, y, int(counts[ids[y, x]]), data))
+    def pairs(a, b):
+        return sorted({(hashes[p], hashes[q]) for p, q in zip(a.tolist(), b.tolist())})
+    return {"tiles": tiles, "right": pairs(left, right), "down": pairs(up, down)}
+
+class Builder:
+
+    # a tile set made from many images and kept up to date image by image.
+    # index.json maps tile content hashes to ids, which never change, and
+    # keeps what every image added, so a changed image can be taken back out
+    def __init__(self, tile_dir, tile_size = 3):
+        self.tile_dir = tile_dir
+        self.index_path = os.path.join(tile_dir, "index.json")
+        # by id: content hash, image it was first seen in and where
+        self.tiles = []
+        # by image path: file hash, tile counts and neighbour pairs as ids
+        self.images = {}
+        # tiles added since the atlas was last written
+        self.new_images = []
+        self.tile_size = tile_size
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as file:
+                index = json.load(file)
+            self.tile_size = index["tile_size"]
+            self.tiles = index["tiles"]
+            self.images = index["images"]
+        self.ids = {tile["hash"]: i for i, tile in enumerate(self.tiles)}
+
+    def build(self, img_paths, jobs = None):
+        if (not os.path.exists(self.index_path)
+                and os.path.exists(os.path.join(self.tile_dir, "tiles.json"))):
+            # its tiles have no hashes to keep ids by
+            raise ValueError(f"{self.tile_dir} is a tile set not made by -b")
+        os.makedirs(self.tile_dir, exist_ok = True)
+        todo = []
+        for img_path in img_paths:
+            img_path = os.path.normpath(img_path)
+            digest = file_digest(img_path)
+            if self.images.get(img_path, {}).get("digest") != digest:
+                todo.append((img_path, digest))
+        print(f"{len(todo)} of {len(img_paths)} images new or changed")
+        if not todo:
+            return
+        tasks = [(img_path, self.tile_size) for img_path, _ in todo]
+        pool = make_pool(jobs) if jobs != 1 and len(tasks) > 1 else None
+        # in image order, so ids don't depend on which worker is faster
+        results = pool.imap(image_tiles, tasks) if pool else map(image_tiles, tasks)
+        try:
+            for (img_path, digest), result in zip(todo, results):
+                count = len(self.tiles)
+                self.add(img_path, digest, result)
+                print(f"Image {img_path}: {len(result['tiles'])} tiles, "
+                      f"{len(self.tiles) - count} new")
+        finally:
+            if pool:
+                pool.terminate()
+        self.save()
+
+    def add(self, img_path, digest, result):
+        ts = self.tile_size
+        counts = {}
+        for tile_hash, x, y, count, data in result["tiles"]:
+            i = self.ids.get(tile_hash)
+            if i is None:
+                i = len(self.tiles)
+                self.ids[tile_hash] = i
+                self.tiles.append({"hash": tile_hash, "source": img_path, "x": x, "y": y})
+                img = pygame.image.frombuffer(data, (ts, ts), "RGBA")
+                self.new_images.append(img.copy())
+            counts[str(i)] = count
+        ids = self.ids
+        # replaces what an older version of the image added
+        self.images[img_path] = {
+            "digest": digest,
+            "counts": counts,
+            "right": [[ids[a], ids[b]] for a, b in result["right"]],
+            "down": [[ids[a], ids[b]] for a, b in result["down"]]
+        }
+
+    def tile_desc(self):
+        # every image's counts and pairs merged, a tile no image has any more
+        # keeps its id with weight 0 and no neighbours, so it is never placed
+        tiles = []
+        for tile in self.tiles:
+            tiles.append({
+                "x": tile["x"],
+                "y": tile["y"],
+                "source": tile["source"],
+                "weight": 0,
+                "constraints": {"left": set(), "right": set(), "up": set(), "down": set()}
+            })
+        for image in self.images.values():
+            for i, count in image["counts"].items():
+                tiles[int(i)]["weight"] += count
+            for a, b in image["right"]:
+                tiles[a]["constraints"]["right"].add(b)
+                tiles[b]["constraints"]["left"].add(a)
+            for a, b in image["down"]:
+                tiles[a]["constraints"]["down"].add(b)
+                tiles[b]["constraints"]["up"].add(a)
+        for tile in tiles:
+            tile["constraints"] = {name: sorted(v) for name, v in tile["constraints"].items()}
+        return {"tiles": tiles}
+
+    def save(self):
+        images = load_atlas(self.tile_dir, 1) if atlas_scales(self.tile_dir) else []
+        if len(images) + len(self.new_images) != len(self.tiles):
+            raise ValueError(f"the atlas in {self.tile_dir} doesn't match its index.json")
+        save_atlas(self.tile_dir, images + self.new_images)
+        self.new_images = []
+        desc = self.tile_desc()
+        with open(os.path.join(self.tile_dir, "tiles.json"), "w") as file:
+            json.dump(desc, file, indent = 4)
+        # pruning would renumber, ids have to stay what index.json says
+        compile_tiles(self.tile_dir, desc, prune = False)
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "w") as file:
+            json.dump({"tile_size": self.tile_size, "tiles": self.tiles,
+                       "images": self.images}, file)
+        os.replace(tmp_path, self.index_path)
+        print(f"{len(self.tiles)} tiles from {len(self.images)} images in {self.tile_dir}")
+
+def option(args, name, default):
+    # int value after name, both removed from args
+    if name not in args:
+        return default
+    i = args.index(name)
+    value = int(args[i + 1]) if i + 1 < len(args) else 0
+    del args[i:i + 2]
+    return value
 
 def main():
+    if len(sys.argv) > 2 and sys.argv[1] == "-c":
+        compile_tiles(sys.argv[2])
+        return
+    if len(sys.argv) > 1 and sys.argv[1] == "-b":
+        args = sys.argv[2:]
+        tile_size = option(args, "-t", 3)
+        jobs = option(args, "-j", None)
+        if len(args) < 2 or tile_size < 1:
+            usage()
+            sys.exit("*** expected a tile directory and images")
+        try:
+            Builder(args[0], tile_size).build(args[1:], jobs)
+        except ValueError as e:
+            sys.exit(f"*** {e}")
+        return
     pygame.init()
-    img_path = sys.argv[1] if len(sys.argv) > 1 else None
-    tile_size = int(sys.argv[2]) if len(sys.argv) > 2 else 3
-    if not img_path:
+    args = sys.argv[1:]
+    symmetry = option(args, "-s", 1)
+    upscale = option(args, "-u", 1)
+    hq_path = None
+    if "-q" in args:
+        i = args.index("-q")
+        hq_path = args[i + 1] if i + 1 < len(args) else None
+        del args[i:i + 2]
+    overlap = "-o" in args
+    args = [arg for arg in args if arg != "-o"]
+    img_path = args[0] if args else None
+    tile_size = int(args[1]) if len(args) > 1 else 3
+    if not img_path or "-h" in args:
         usage()
         sys.exit("*** expected path to image")
-    App(img_path, tile_size).run()
+    if symmetry not in (1, 2, 4, 8):
+        usage()
+        sys.exit("*** symmetry must be 1, 2, 4 or 8")
+    if upscale < 1 or (hq_path and upscale == 1):
+        usage()
+        sys.exit("*** -u must be 2 or more, and is needed by -q")
+    App(img_path, tile_size, overlap, symmetry, upscale, hq_path).run()
     pygame.quit()
 
 if __name__ == "__main__":
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import json
+import time
+import argparse
+from solver import Solver, Tileset, MIN_WINDOW
+from farm import generate, farm, FarmStats
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        prog = "./wfc.py generate",
+        description = "Generate layouts headlessly, without opening a window.")
+    parser.add_argument("tile_dir", help = "tile directory made by gen_tiles.py")
+    parser.add_argument("--seed", type = int, default = 0,
+                        help = "first seed, --count seeds are solved from here")
+    parser.add_argument("--count", type = int, default = 1)
+    parser.add_argument("--jobs", type = int, default = None,
+                        help = "worker processes for --count, defaults to one per cpu")
+    parser.add_argument("--width", type = int, default = 10)
+    parser.add_argument("--height", type = int, default = 10)
+    parser.add_argument("--heuristic", choices = ["size", "entropy"], default = "size",
+                        help = "pick the cell with the fewest tiles or the lowest weighted entropy")
+    parser.add_argument("--backtrack", choices = ["rows", "trail"], default = "rows",
+                        help = "retry failed rows, or undo decisions from a trail first")
+    parser.add_argument("--max-depth", type = int, default = 8,
+                        help = "decisions --backtrack trail can undo")
+    parser.add_argument("--budget", type = int, default = 20,
+                        help = "undos --backtrack trail may spend per new row")
+    parser.add_argument("--stream", action = "store_true",
+                        help = "write rows to stdout as json lines while solving, "
+                               "--height 0 streams forever")
+    parser.add_argument("--window", type = int, default = 8,
+                        help = f"rows --stream keeps in memory, at least {MIN_WINDOW}")
+    parser.add_argument("--checkpoint", default = None,
+                        help = "--stream resumes from this snapshot if it exists and "
+                               "saves to it in the background")
+    parser.add_argument("--checkpoint-interval", type = float, default = 60,
+                        help = "seconds between --checkpoint snapshots")
+    parser.add_argument("--chunks", type = int, nargs = 2, metavar = ("X", "Y"),
+                        help = "solve a world of X by Y chunks of --width x --height "
+                               "cells, each written to --out as it is done")
+    parser.add_argument("--margin", type = int, default = 4,
+                        help = "extra rows and columns --chunks solves and cuts off, "
+                               "raise it when chunks don't fit their neighbours")
+    parser.add_argument("--out", default = "out", help = "output directory")
+    parser.add_argument("--npy", action = "store_true",
+                        help = "also write the tile grid as .npy")
+    parser.add_argument("--png", action = "store_true",
+                        help = "also render the layout to .png")
+    parser.add_argument("--scale", type = int, default = 1,
+                        help = "upscale factor for --png")
+    parser.add_argument("--source", default = None,
+                        help = "cut --png tiles from this image instead of the set's atlas")
+    parser.add_argument("--source-scale", type = int, default = 1,
+                        help = "size of --source relative to the original image")
+    parser.add_argument("--tile-size", type = int, default = 3,
+                        help = "tile size used by gen_tiles.py")
+    args = parser.parse_args(argv)
+    if args.window < MIN_WINDOW:
+        parser.error(f"--window must be at least {MIN_WINDOW}")
+    if args.checkpoint:
+        from checkpoint import check_path
+        error = check_path(args.checkpoint)
+        if error:
+            parser.error(error)
+    return args
+
+def save_json(path, result):
+    with open(path, "w") as file:
+        json.dump(result, file)
+
+def save_npy(path, result):
+    import numpy
+    numpy.save(path, numpy.array(result["tiles"], dtype = numpy.int32))
+
+def save_png(path, result, images, scale = 1):
+    import pygame
+    tw, th = images[0].get_size()
+    img = pygame.Surface((result["width"] * tw, result["height"] * th))
+    for y, row in enumerate(result["tiles"]):
+        for x, v in enumerate(row):
+            if v >= 0:
+                img.blit(images[v], (x * tw, y * th))
+    if scale != 1:
+        img = pygame.transform.scale_by(img, scale)
+    pygame.image.save(img, path)
+
+def write_stream(solver, file, window = 8, checkpointer = None):
+    # one json list of tile indices per line, bottom row first
+    for row in solver.stream(window):
+        file.write(json.dumps(row) + "\n")
+        file.flush()
+        if checkpointer:
+            checkpointer.update(solver)
+
+def main(argv):
+    args = parse_args(argv)
+    tileset = Tileset.load(args.tile_dir)
+    if args.stream:
+        solver = None
+        checkpointer = None
+        if args.checkpoint:
+            from checkpoint import Checkpointer, load_solver
+            solver = load_solver(tileset, args.checkpoint)
+            checkpointer = Checkpointer(args.checkpoint, args.checkpoint_interval)
+            checkpointer.start()
+        if solver is None:
+            solver = Solver(tileset, args.width, args.height or None, args.seed, args.heuristic)
+        solver.verbose = False
+        if args.backtrack == "trail":
+            solver.enable_trail(args.max_depth, args.budget)
+        interrupted = False
+        try:
+            write_stream(solver, sys.stdout, args.window, checkpointer)
+        except BrokenPipeError:
+            pass
+        except KeyboardInterrupt:
+            interrupted = True
+        if checkpointer:
+            # an interrupt can land halfway through a step, then the last
+            # snapshot is kept instead
+            if not interrupted:
+                checkpointer.save(solver)
+            checkpointer.stop()
+        return
+    if args.chunks:
+        # numpy, only needed here
+        from chunks import generate_world
+        chunks_x, chunks_y = args.chunks
+        start = time.perf_counter()
+        for result in generate_world(tileset, chunks_x, chunks_y, args.width, args.height,
+                                     args.out, args.seed, args.jobs, margin = args.margin):
+            print(f"Chunk {result['cx']}, {result['cy']} in {result['time']:.3f}s, "
+                  f"{result['retries']} row retries, {result['restarts']} restarts")
+        cells = chunks_x * chunks_y * args.width * args.height
+        elapsed = time.perf_counter() - start
+        print(f"{cells} cells in {elapsed:.2f}s ({cells / elapsed:.0f} cells/sec)")
+        return
+    os.makedirs(args.out, exist_ok = True)
+    images = None
+    if args.png:
+        from atlas import load_tile_images
+        images = load_tile_images(args.tile_dir, tileset, args.source,
+                                  args.source_scale, args.tile_size, 1)
+    seeds = range(args.seed, args.seed + args.count)
+    trail = (args.max_depth, args.budget) if args.backtrack == "trail" else None
+    if args.count > 1:
+        results = farm(tileset, seeds, args.width, args.height, args.jobs,
+                       heuristic = args.heuristic, trail = trail)
+    else:
+        results = (generate(tileset, args.width, args.height, seed,
+                            heuristic = args.heuristic, trail = trail)
+                   for seed in seeds)
+    stats = FarmStats()
+    for result in results:
+        stats.add(result)
+        seed = result["seed"]
+        print(f"Seed {seed} {args.width}x{args.height} in {result['time']:.3f}s, "
+              f"{result['retries']} row retries, {result['restarts']} restarts, "
+              f"{result['backtracks']} backtracks")
+        base = os.path.join(args.out, str(seed))
+        save_json(base + ".json", result)
+        if args.npy:
+            save_npy(base + ".npy", result)
+        if args.png:
+            save_png(base + ".png", result, images, args.scale)
+    if args.count > 1:
+        stats.report()
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,842 @@
+import os
+import json
+import math
+import mmap
+import struct
+import heapq
+import zlib
+import random
+import itertools
+from collections import deque
+
+# neighbour offsets in grid space, rows grow upwards
+DIRECTIONS = {
+    "left": (-1, 0),
+    "right": (1, 0),
+    "up": (0, 1),
+    "down": (0, -1),
+}
+
+def bits(mask):
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+def is_collapsed(domain):
+    # one tile left, or none
+    return domain & (domain - 1) == 0
+
+# compiled tileset, little endian:
+#   header  magic, version, tile count, 64 bit words per mask, model
+#   float64 weight of every tile
+#   int32   x, y of every tile in the source image, -1 if unknown
+#   uint64  adjacency masks for every direction, tile and word
+COMPILED_MAGIC = b"WFCT"
+COMPILED_VERSION = 2
+COMPILED_HEADER = struct.Struct("<4sIIII")
+# "tiled" sets place a whole tile per cell, "overlap" ones a pattern per
+# pixel that overlaps its neighbours
+MODELS = ["tiled", "overlap"]
+
+# solver snapshot, little endian:
+#   header  magic, version, tile count and crc of the tileset it was made
+#           with, width, words per domain, rows in memory, max height (-1
+#           for none), row offset, row and backtracking counters, done,
+#           contradiction, heuristic, heap and edge entry counts
+#   rng     Mersenne Twister state and the cached gauss value
+#   uint64  domain words of every cell, rows bottom up
+#   heap    key, tie breaker, x, y of every entry
+#   edges   y, x and tiles allowed of every edge mask
+SNAPSHOT_MAGIC = b"WFCS"
+SNAPSHOT_VERSION = 1
+SNAPSHOT_HEADER = struct.Struct("<4sIIIIIIqqqqqqqqqq??BII")
+SNAPSHOT_RNG = struct.Struct("<625I?d")
+SNAPSHOT_HEAP = struct.Struct("<ddii")
+SNAPSHOT_EDGE = struct.Struct("<qi")
+HEURISTICS = ["size", "entropy"]
+# biggest set settle() sweeps, support_many() tables are 16MB a direction
+SWEEP_MAX_TILES = 2048
+# fewest rows stream() may keep, retry_row() can drop three of them
+MIN_WINDOW = 4
+
+class Tileset:
+
+    def __init__(self, compat, weights = None, positions = None, images = None,
+                 model = "tiled"):
+        # compat[dir][t] is the mask of tiles allowed next to t in dir
+        self.compat = compat
+        self.model = model
+        self.count = len(compat["left"])
+        self.full = (1 << self.count) - 1
+        self.weights = weights or [1] * self.count
+        # a tile with weight 0 is never picked
+        self.weight_logs = [w * math.log(w) if w else 0 for w in self.weights]
+        self.entropy_cache = {}
+        self.choice_cache = {}
+        self.positions = positions or [(-1, -1)] * self.count
+        self.images = images or [f"{i}.png" for i in range(self.count)]
+        # support of a whole domain, looked up 8 tiles at a time, built by
+        # support_tables_for() the first time a direction is asked for
+        self.support_tables = {}
+        # the same tables as numpy arrays, built on first use by support_many()
+        self.support_arrays = {}
+
+    @staticmethod
+    def from_desc(tile_desc):
+        tiles = tile_desc["tiles"]
+        compat = {}
+        for name in DIRECTIONS:
+            masks = []
+            for tile in tiles:
+                mask = 0
+                for v in tile["constraints"][name]:
+                    mask |= 1 << v
+                masks.append(mask)
+            compat[name] = masks
+        weights = [tile.get("weight", 1) for tile in tiles]
+        positions = [(tile.get("x", -1), tile.get("y", -1)) for tile in tiles]
+        # sets with an atlas have no png per tile
+        images = [tile.get("image", f"{i}.png") for i, tile in enumerate(tiles)]
+        return Tileset(compat, weights, positions, images, tile_desc.get("model", "tiled"))
+
+    def to_desc(self):
+        tiles = []
+        for t in range(self.count):
+            x, y = self.positions[t]
+            tiles.append({
+                "x": x,
+                "y": y,
+                "weight": self.weights[t],
+                "constraints": {name: list(bits(self.compat[name][t])) for name in DIRECTIONS}
+            })
+        return {"model": self.model, "tiles": tiles}
+
+    def pruned(self):
+        # arc consistency over the adjacency graph, done once before solving:
+        # a pair is only kept if both tiles allow it, a tile left without
+        # neighbours in some direction can't be placed and is dropped, then
+        # tiles with the same neighbours in every direction are merged into
+        # the first of them. Returns the new tileset and the old tiles every
+        # new tile stands for
+        compat = {name: list(masks) for name, masks in self.compat.items()}
+        for name, opposite in (("right", "left"), ("up", "down")):
+            allowed = [0] * self.count
+            for a, mask in enumerate(compat[name]):
+                for b in bits(mask):
+                    allowed[b] |= 1 << a
+            for b in range(self.count):
+                compat[opposite][b] &= allowed[b]
+            allowed = [0] * self.count
+            for b, mask in enumerate(compat[opposite]):
+                for a in bits(mask):
+                    allowed[a] |= 1 << b
+            for a in range(self.count):
+                compat[name][a] &= allowed[a]
+        alive = self.full
+        while True:
+            dead = [t for t in bits(alive)
+                    if any(not masks[t] & alive for masks in compat.values())]
+            if not dead:
+                break
+            for t in dead:
+                alive &= ~(1 << t)
+        groups = {}
+        for t in bits(alive):
+            key = tuple(compat[name][t] & alive for name in DIRECTIONS)
+            groups.setdefault(key, []).append(t)
+        groups = list(groups.values())
+        new_ids = {t: i for i, members in enumerate(groups) for t in members}
+        new_compat = {}
+        for name in DIRECTIONS:
+            masks = []
+            for members in groups:
+                mask = 0
+                for t in bits(compat[name][members[0]] & alive):
+                    mask |= 1 << new_ids[t]
+                masks.append(mask)
+            new_compat[name] = masks
+        weights = [sum(self.weights[t] for t in members) for members in groups]
+        positions = [self.positions[members[0]] for members in groups]
+        images = [self.images[members[0]] for members in groups]
+        return Tileset(new_compat, weights, positions, images, self.model), groups
+
+    @staticmethod
+    def load(tile_dir):
+        json_path = os.path.join(tile_dir, "tiles.json")
+        bin_path = os.path.join(tile_dir, "tiles.bin")
+        if os.path.exists(bin_path) and not (os.path.exists(json_path) and
+                os.path.getmtime(json_path) > os.path.getmtime(bin_path)):
+            try:
+                return Tileset.load_compiled(bin_path)
+            except ValueError:
+                pass
+        return Tileset.load_json(json_path)
+
+    @staticmethod
+    def load_json(path):
+        with open(path) as file:
+            return Tileset.from_desc(json.load(file))
+
+    @staticmethod
+    def load_compiled(path):
+        with open(path, "rb") as file:
+            with mmap.mmap(file.fileno(), 0, access = mmap.ACCESS_READ) as data:
+                if len(data) < COMPILED_HEADER.size:
+                    raise ValueError(f"{path} is truncated")
+                magic, version, count, words, model = COMPILED_HEADER.unpack_from(data)
+                if magic != COMPILED_MAGIC or version != COMPILED_VERSION:
+                    raise ValueError(f"{path} is not a version {COMPILED_VERSION} tileset")
+                size = 8 * words
+                offset = COMPILED_HEADER.size
+                if len(data) != offset + 16 * count + 4 * count * size:
+                    raise ValueError(f"{path} is truncated")
+                weights = list(struct.unpack_from(f"<{count}d", data, offset))
+                offset += 8 * count
+                coords = struct.unpack_from(f"<{2 * count}i", data, offset)
+                positions = list(zip(coords[0::2], coords[1::2]))
+                offset += 8 * count
+                compat = {}
+                for name in DIRECTIONS:
+                    masks = []
+                    for _ in range(count):
+                        masks.append(int.from_bytes(data[offset:offset + size], "little"))
+                        offset += size
+                    compat[name] = masks
+        return Tileset(compat, weights, positions, model = MODELS[model])
+
+    def save_compiled(self, path):
+        words = max(1, (self.count + 63) // 64)
+        size = 8 * words
+        parts = [COMPILED_HEADER.pack(COMPILED_MAGIC, COMPILED_VERSION, self.count, words,
+                                      MODELS.index(self.model))]
+        parts.append(struct.pack(f"<{self.count}d", *self.weights))
+        parts.append(struct.pack(f"<{2 * self.count}i", *sum(self.positions, ())))
+        for name in DIRECTIONS:
+            for mask in self.compat[name]:
+                parts.append(mask.to_bytes(size, "little"))
+        # written aside and moved over so a reader never sees half a file
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as file:
+            file.write(b"".join(parts))
+        os.replace(tmp_path, path)
+
+    def fingerprint(self):
+        # crc of the adjacency masks, snapshots only resume on the same set
+        words = max(1, (self.count + 63) // 64)
+        crc = 0
+        for name in DIRECTIONS:
+            for mask in self.compat[name]:
+                crc = zlib.crc32(mask.to_bytes(8 * words, "little"), crc)
+        return crc
+
+    def entropy(self, domain):
+        # shannon entropy of a domain, weighted by how often tiles occur
+        h = self.entropy_cache.get(domain)
+        if h is None:
+            total = 0
+            acc = 0
+            for i in bits(domain):
+                total += self.weights[i]
+                acc += self.weight_logs[i]
+            h = math.log(total) - acc / total if total else 0
+            if len(self.entropy_cache) > 1 << 16:
+                self.entropy_cache.clear()
+            self.entropy_cache[domain] = h
+        return h
+
+    def choose(self, domain, rng):
+        # weighted pick from a domain, cumulative weights cached per domain
+        entry = self.choice_cache.get(domain)
+        if entry is None:
+            tiles = list(bits(domain))
+            entry = (tiles, list(itertools.accumulate(self.weights[i] for i in tiles)))
+            if len(self.choice_cache) > 1 << 16:
+                self.choice_cache.clear()
+            self.choice_cache[domain] = entry
+        tiles, cum_weights = entry
+        return rng.choices(tiles, cum_weights = cum_weights)[0]
+
+    def prepare(self):
+        # every direction's tables built now, so workers forked after this
+        # share them instead of each building its own
+        for name in DIRECTIONS:
+            self.support_tables_for(name)
+
+    def support_tables_for(self, name):
+        tables = self.support_tables.get(name)
+        if tables is not None:
+            return tables
+        masks = self.compat[name]
+        tables = []
+        for k in range(0, self.count, 8):
+            table = [0] * 256
+            for b in range(1, 256):
+                low = b & -b
+                i = k + low.bit_length() - 1
+                extra = masks[i] if i < self.count else 0
+                table[b] = table[b ^ low] | extra
+            tables.append(table)
+        self.support_tables[name] = tables
+        return tables
+
+    def support(self, domain, name):
+        tables = self.support_tables.get(name)
+        if tables is None:
+            tables = self.support_tables_for(name)
+        mask = 0
+        k = 0
+        while domain:
+            mask |= tables[k][domain & 255]
+            domain >>= 8
+            k += 1
+        return mask
+
+    def support_many(self, domains, name):
+        # support() of every domain in a (..., words) uint64 array at once
+        import numpy
+        tables = self.support_arrays.get(name)
+        if tables is None:
+            words = domains.shape[-1]
+            groups = (self.count + 7) // 8
+            data = b"".join(mask.to_bytes(8 * words, "little") for mask in self.compat[name])
+            masks = numpy.zeros((groups * 8, words), numpy.uint64)
+            masks[:self.count] = numpy.frombuffer(data, "<u8").reshape(-1, words)
+            masks = masks.reshape(groups, 8, words)
+            # same as support_tables_for(), each bit doubles the filled part
+            tables = numpy.zeros((groups, 256, words), numpy.uint64)
+            for i in range(8):
+                tables[:, 1 << i:2 << i] = tables[:, :1 << i] | masks[:, i, None]
+            self.support_arrays[name] = tables
+        octets = numpy.ascontiguousarray(domains).view(numpy.uint8)
+        mask = numpy.zeros_like(domains)
+        for k, table in enumerate(tables):
+            mask |= table[octets[..., k]]
+        return mask
+
+def settle(tileset, width, height, masks, bulk = True):
+    # arc consistency over a whole width x height grid starting from masks,
+    # returns the tiles left for every cell that lost some, so a solver that
+    # builds the grid row by row only keeps tiles later rows can build on.
+    # bulk sweeps the whole grid with numpy instead of the worklist, which
+    # only pays off when most cells start constrained, and not for sets
+    # whose tables would take 4 * count^2 bytes per direction
+    solver = Solver(tileset, width, height)
+    solver.rows = [solver.new_row() for _ in range(height)]
+    solver.height = height
+    for (x, y), mask in masks.items():
+        solver.rows[y][x] &= mask
+    if bulk and tileset.count <= SWEEP_MAX_TILES:
+        solver.sweep()
+    else:
+        solver.propagate(list(masks))
+    return {(x, y): domain for y, row in enumerate(solver.rows)
+            for x, domain in enumerate(row) if domain != tileset.full}
+
+class Solver:
+
+    def __init__(self, tileset, width = 10, height = None, seed = None, heuristic = "size"):
+        self.tileset = tileset
+        self.width = width
+        # None grows the grid upwards forever
+        self.max_height = height
+        self.height = 1
+        self.domain = tileset.full
+        # tile bitmask of every cell, rows bottom up, the ints are shared
+        # between cells with the same tiles left
+        self.rows = [self.new_row()]
+        self.num_rows = 0
+        self.backtracking_level = 0
+        self.random = random.Random(seed)
+        # "size" or "entropy", what pick_cell minimizes
+        self.heuristic = heuristic
+        # (key, tie breaker, x, y), stale entries are skipped when popped
+        self.heap = []
+        self.verbose = True
+        self.done = False
+        self.retries = 0
+        self.restarts = 0
+        # row retries without a new row before starting over, None retries forever
+        self.max_retries = None
+        self.stalled = 0
+        self.best_height = 1
+        self.contradiction = False
+        # rows committed below self.rows, they are frozen and no longer kept
+        self.row_offset = 0
+        # (x, y) of cells whose domain changed since take_dirty(), only kept
+        # when something draws incrementally, may name rows that are gone
+        self.dirty = None
+        # a stats.Stats counting propagations, None collects nothing
+        self.stats = None
+        # trail of (x, y, old domain), None for an appended row, only kept
+        # when backtracking through decisions is enabled
+        self.trail = None
+        self.trail_base = 0
+        self.decisions = deque()
+        self.max_depth = 0
+        self.budget = 0
+        self.budget_used = 0
+        self.backtracks = 0
+        # {y: [(x, tiles allowed)]} for cells next to tiles placed outside
+        # the grid, set by constrain(), y counts committed rows
+        self.edges = None
+        self.prepare_top_row()
+
+    def enable_trail(self, max_depth = 8, budget = 20):
+        # undo up to max_depth decisions, at most budget times per new row,
+        # before falling back to retrying rows
+        self.trail = deque()
+        self.max_depth = max_depth
+        self.budget = budget
+
+    def constrain(self, masks):
+        # masks maps (x, y) to the tiles allowed there, e.g. the ones that
+        # fit next to a chunk solved before this one
+        self.edges = {}
+        for (x, y), mask in masks.items():
+            self.edges.setdefault(y, []).append((x, mask))
+        changed = []
+        for y in range(self.height):
+            changed += self.apply_edges(y)
+        self.propagate(changed)
+
+    def apply_edges(self, y):
+        # returns the cells of row y that lost tiles to the edges
+        changed = []
+        if not self.edges:
+            return changed
+        row = self.rows[y]
+        for x, mask in self.edges.get(self.row_offset + y, ()):
+            domain = row[x]
+            if domain & mask == domain:
+                continue
+            if self.trail is not None:
+                self.trail.append((x, y, domain))
+            row[x] = domain & mask
+            if not row[x]:
+                self.contradiction = True
+            self.push_cell(x, y)
+            changed.append((x, y))
+        return changed
+
+    def track_dirty(self):
+        self.dirty = {(x, y) for y in range(self.height) for x in range(self.width)}
+
+    def take_dirty(self):
+        dirty = self.dirty
+        self.dirty = set()
+        return dirty
+
+    def mark_row(self, y):
+        if self.dirty is not None:
+            self.dirty.update((x, y) for x in range(self.width))
+
+    def log(self, msg):
+        if self.verbose:
+            print(msg)
+
+    def new_row(self):
+        return [self.domain] * self.width
+
+    def domain_array(self):
+        # every domain as 64 bit little endian words, (height, width, words)
+        # rows bottom up, for whole grid work in numpy
+        import numpy
+        words = max(1, (self.tileset.count + 63) // 64)
+        data = b"".join(domain.to_bytes(8 * words, "little")
+                        for row in self.rows for domain in row)
+        return numpy.frombuffer(data, "<u8").reshape(self.height, self.width, words)
+
+    def cell_key(self, domain):
+        if self.heuristic == "entropy":
+            return self.tileset.entropy(domain)
+        return domain.bit_count()
+
+    def push_cell(self, x, y):
+        domain = self.rows[y][x]
+        if domain & (domain - 1):
+            entry = (self.cell_key(domain), self.random.random(), x, y)
+            heapq.heappush(self.heap, entry)
+
+    def pick_cell(self):
+        while self.heap:
+            key, _, x, y = heapq.heappop(self.heap)
+            if y >= self.height:
+                continue
+            domain = self.rows[y][x]
+            if is_collapsed(domain) or self.cell_key(domain) != key:
+                continue
+            return (x, y, domain)
+        return (0, 0, None)
+
+    def propagate(self, changed):
+        # AC-3 style worklist, only neighbours of changed cells are revisited
+        todo = deque(changed)
+        queued = set(todo)
+        visited = 0
+        touched = 0
+        while todo:
+            x, y = todo.popleft()
+            queued.discard((x, y))
+            visited += 1
+            domain = self.rows[y][x]
+            if not domain:
+                continue
+            for name, (dx, dy) in DIRECTIONS.items():
+                nx = x + dx
+                ny = y + dy
+                if nx < 0 or nx >= self.width or ny < 0 or ny >= self.height:
+                    continue
+                row = self.rows[ny]
+                other = row[nx]
+                allowed = other & self.tileset.support(domain, name)
+                if allowed == other:
+                    continue
+                if is_collapsed(other):
+                    # a tile fixed before, e.g. by an edge mask, doesn't fit,
+                    # left as is for retry_row() or undo() to deal with
+                    self.contradiction = True
+                    continue
+                if self.trail is not None:
+                    self.trail.append((nx, ny, other))
+                row[nx] = allowed
+                touched += 1
+                if self.dirty is not None:
+                    self.dirty.add((nx, ny))
+                if not allowed:
+                    self.contradiction = True
+                self.push_cell(nx, ny)
+                if (nx, ny) not in queued:
+                    queued.add((nx, ny))
+                    todo.append((nx, ny))
+        if self.stats is not None:
+            self.stats.propagated(visited, touched, self.contradiction)
+
+    def sweep(self):
+        # bulk propagate(), every domain in memory is ANDed with what its
+        # four neighbours support, the whole grid per step until nothing
+        # changes. Pays off when many cells start constrained at once
+        import numpy
+        before = self.domain_array()
+        domains = before.copy()
+        height, width = self.height, self.width
+        changed = True
+        while changed:
+            changed = False
+            for name, (dx, dy) in DIRECTIONS.items():
+                support = self.tileset.support_many(domains, name)
+                # the support of (x, y) applies to (x + dx, y + dy)
+                target = domains[max(dy, 0):height + min(dy, 0), max(dx, 0):width + min(dx, 0)]
+                source = support[max(-dy, 0):height + min(-dy, 0),
+                                 max(-dx, 0):width + min(-dx, 0)]
+                narrowed = target & source
+                if not numpy.array_equal(narrowed, target):
+                    target[...] = narrowed
+                    changed = True
+        for y, x in numpy.argwhere((domains != before).any(axis = 2)).tolist():
+            domain = int.from_bytes(domains[y, x].tobytes(), "little")
+            if self.trail is not None:
+                self.trail.append((x, y, self.rows[y][x]))
+            self.rows[y][x] = domain
+            if self.dirty is not None:
+                self.dirty.add((x, y))
+            if not domain:
+                self.contradiction = True
+            self.push_cell(x, y)
+
+    def prepare_top_row(self):
+        # a fresh top row only needs the constraints of the row below it
+        self.contradiction = False
+        changed = self.apply_edges(self.height - 1)
+        if self.height > 1:
+            changed += [(x, self.height - 2) for x in range(self.width)]
+        self.propagate(changed)
+        for x in range(self.width):
+            self.push_cell(x, self.height - 1)
+        self.mark_row(self.height - 1)
+
+    def restart(self):
+        self.clear_trail()
+        for y in range(self.height):
+            self.mark_row(y)
+        # rows already streamed out can't change, start over above them,
+        # the edges commit_row() left keep the new bottom row fitting
+        self.rows = [self.new_row()]
+        self.height = 1
+        self.num_rows = 0
+        self.backtracking_level = 0
+        self.stalled = 0
+        self.best_height = self.height
+        self.budget_used = 0
+        self.restarts += 1
+        self.heap = []
+        self.prepare_top_row()
+
+    def on_backtrack_start(self):
+        pass
+
+    def on_backtrack_end(self):
+        pass
+
+    def clear_trail(self):
+        if self.trail is not None:
+            self.trail_base += len(self.trail)
+            self.trail.clear()
+            self.decisions.clear()
+
+    def trim_trail(self):
+        # the oldest decision can't be undone anymore, forget its trail
+        oldest = self.decisions[0][0] if self.decisions else self.trail_base + len(self.trail)
+        while self.trail_base < oldest:
+            self.trail.popleft()
+            self.trail_base += 1
+
+    def undo(self, mark):
+        while self.trail_base + len(self.trail) > mark:
+            entry = self.trail.pop()
+            if entry is None:
+                self.rows.pop()
+                self.height -= 1
+                self.mark_row(self.height)
+                continue
+            x, y, domain = entry
+            if y < 0:
+                continue
+            self.rows[y][x] = domain
+            self.push_cell(x, y)
+            if self.dirty is not None:
+                self.dirty.add((x, y))
+
+    def backtrack(self):
+        # undo decisions until one has an alternative left that propagates
+        while self.contradiction:
+            if not self.decisions or self.budget_used >= self.budget:
+                self.clear_trail()
+                return False
+            mark, x, y, v = self.decisions.pop()
+            self.undo(mark)
+            self.backtracks += 1
+            self.budget_used += 1
+            self.contradiction = False
+            row = self.rows[y]
+            self.trail.append((x, y, row[x]))
+            row[x] &= ~(1 << v)
+            if self.dirty is not None:
+                self.dirty.add((x, y))
+            if not row[x]:
+                self.contradiction = True
+                continue
+            self.push_cell(x, y)
+            self.propagate([(x, y)])
+        return True
+
+    def decide(self, x, y, v):
+        if self.trail is not None:
+            self.decisions.append((self.trail_base + len(self.trail), x, y, v))
+            if len(self.decisions) > self.max_depth:
+                self.decisions.popleft()
+                self.trim_trail()
+            self.trail.append((x, y, self.rows[y][x]))
+        self.rows[y][x] = 1 << v
+        if self.dirty is not None:
+            self.dirty.add((x, y))
+        self.propagate([(x, y)])
+
+    def retry_row(self):
+        self.log("retrying last row!")
+        self.clear_trail()
+        self.retries += 1
+        self.stalled += 1
+        if self.max_retries is not None and self.stalled > self.max_retries:
+            self.log("stuck, starting over!")
+            self.restart()
+            return
+        if (self.num_rows == len(self.rows) and self.backtracking_level < 3
+                and len(self.rows) > 1):
+            self.log("row failed twice, backtracking!")
+            self.rows.pop()
+            self.height -= 1
+            self.mark_row(self.height)
+            if self.backtracking_level == 0:
+                self.on_backtrack_start()
+            self.backtracking_level += 1
+        self.num_rows = len(self.rows)
+        self.rows[-1] = self.new_row()
+        self.prepare_top_row()
+
+    def next_row(self):
+        if self.backtracking_level == 1:
+            self.on_backtrack_end()
+        self.backtracking_level = max(self.backtracking_level - 1, 0)
+        if self.max_height is not None and self.row_offset + self.height >= self.max_height:
+            self.done = True
+            return
+        self.rows.append(self.new_row())
+        self.height += 1
+        if self.trail is not None:
+            self.trail.append(None)
+        if self.height > self.best_height:
+            self.best_height = self.height
+            self.stalled = 0
+            self.budget_used = 0
+        self.prepare_top_row()
+
+    def collapse(self):
+        if self.done:
+            return
+        if self.contradiction and self.trail is not None and self.backtrack():
+            return
+        x, y, domain = self.pick_cell()
+        # no need to collapse the rest of a row that already failed
+        if domain is None or self.contradiction:
+            self.log("nothing to collapse!")
+            if self.contradiction or not all(self.rows[-1]):
+                self.retry_row()
+            else:
+                self.next_row()
+            return
+        v = self.tileset.choose(domain, self.random)
+        # print(f"collapsing {x}, {y}, ({domain.bit_count()}) to {v}")
+        self.decide(x, y, v)
+
+    def solve(self):
+        while not self.done:
+            self.collapse()
+
+    def commit_row(self):
+        # freeze the bottom row, it drops out of propagation and undo
+        row = self.rows.pop(0)
+        self.height -= 1
+        self.row_offset += 1
+        # the row above keeps to it as an edge, once retry_row() or restart()
+        # reset it there is nothing in memory below it anymore
+        if self.edges is None:
+            self.edges = {}
+        self.edges.pop(self.row_offset - 1, None)
+        self.edges.setdefault(self.row_offset, []).extend(
+            (x, self.tileset.support(domain, "up")) for x, domain in enumerate(row))
+        self.num_rows = max(self.num_rows - 1, 0)
+        self.best_height = max(self.best_height - 1, 1)
+        self.heap = [(key, r, x, y - 1) for key, r, x, y in self.heap if y > 0]
+        heapq.heapify(self.heap)
+        if self.dirty is not None:
+            self.dirty = {(x, y - 1) for x, y in self.dirty if y > 0}
+        if self.trail is not None:
+            while any(y == 0 for _, _, y, _ in self.decisions):
+                self.decisions.popleft()
+            self.trim_trail()
+            # entries left on the committed row become no-ops, marks stay valid
+            self.trail = deque(entry if entry is None else (entry[0], entry[1] - 1, entry[2])
+                               for entry in self.trail)
+            self.decisions = deque((mark, x, y - 1, v) for mark, x, y, v in self.decisions)
+        return self.row_tiles(row)
+
+    def to_snapshot(self):
+        # everything needed to carry on later as bytes, see SNAPSHOT_HEADER.
+        # The trail isn't kept, a resumed solver starts with no decisions to
+        # undo, and stats and dirty tracking are up to whoever resumes it
+        tileset = self.tileset
+        words = max(1, (tileset.count + 63) // 64)
+        size = 8 * words
+        # stale entries would be skipped anyway
+        heap = [(key, r, x, y) for key, r, x, y in self.heap
+                if y < self.height and not is_collapsed(self.rows[y][x])
+                and self.cell_key(self.rows[y][x]) == key]
+        edges = [(y, x, mask) for y, masks in (self.edges or {}).items() for x, mask in masks]
+        parts = [SNAPSHOT_HEADER.pack(
+            SNAPSHOT_MAGIC, SNAPSHOT_VERSION, tileset.count, tileset.fingerprint(),
+            self.width, words, self.height,
+            -1 if self.max_height is None else self.max_height,
+            self.row_offset, self.num_rows, self.backtracking_level, self.retries,
+            self.restarts, self.backtracks, self.stalled, self.best_height, self.budget_used,
+            self.done, self.contradiction, HEURISTICS.index(self.heuristic),
+            len(heap), len(edges))]
+        _, state, gauss = self.random.getstate()
+        parts.append(SNAPSHOT_RNG.pack(*state, gauss is not None, gauss or 0))
+        parts.extend(domain.to_bytes(size, "little") for row in self.rows for domain in row)
+        parts.extend(SNAPSHOT_HEAP.pack(*entry) for entry in heap)
+        for y, x, mask in edges:
+            parts.append(SNAPSHOT_EDGE.pack(y, x))
+            parts.append(mask.to_bytes(size, "little"))
+        return b"".join(parts)
+
+    @staticmethod
+    def from_snapshot(tileset, data):
+        if len(data) < SNAPSHOT_HEADER.size:
+            raise ValueError("snapshot is truncated")
+        (magic, version, count, crc, width, words, height, max_height, row_offset,
+         num_rows, backtracking_level, retries, restarts, backtracks, stalled,
+         best_height, budget_used, done, contradiction, heuristic, heap_count,
+         edge_count) = SNAPSHOT_HEADER.unpack_from(data)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            raise ValueError(f"not a version {SNAPSHOT_VERSION} snapshot")
+        if count != tileset.count or crc != tileset.fingerprint():
+            raise ValueError("snapshot was made with a different tileset")
+        size = 8 * words
+        cells = width * height
+        if len(data) != (SNAPSHOT_HEADER.size + SNAPSHOT_RNG.size + cells * size +
+                         heap_count * SNAPSHOT_HEAP.size +
+                         edge_count * (SNAPSHOT_EDGE.size + size)):
+            raise ValueError("snapshot is truncated")
+        solver = Solver(tileset, width, None if max_height < 0 else max_height,
+                        heuristic = HEURISTICS[heuristic])
+        offset = SNAPSHOT_HEADER.size
+        rng = SNAPSHOT_RNG.unpack_from(data, offset)
+        solver.random.setstate((3, rng[:625], rng[626] if rng[625] else None))
+        offset += SNAPSHOT_RNG.size
+        domains = [int.from_bytes(data[i:i + size], "little")
+                   for i in range(offset, offset + cells * size, size)]
+        solver.rows = [domains[y * width:(y + 1) * width] for y in range(height)]
+        offset += cells * size
+        solver.heap = [SNAPSHOT_HEAP.unpack_from(data, offset + i * SNAPSHOT_HEAP.size)
+                       for i in range(heap_count)]
+        heapq.heapify(solver.heap)
+        offset += heap_count * SNAPSHOT_HEAP.size
+        if edge_count:
+            solver.edges = {}
+        for _ in range(edge_count):
+            y, x = SNAPSHOT_EDGE.unpack_from(data, offset)
+            offset += SNAPSHOT_EDGE.size
+            solver.edges.setdefault(y, []).append(
+                (x, int.from_bytes(data[offset:offset + size], "little")))
+            offset += size
+        solver.height = height
+        solver.row_offset = row_offset
+        solver.num_rows = num_rows
+        solver.backtracking_level = backtracking_level
+        solver.retries = retries
+        solver.restarts = restarts
+        solver.backtracks = backtracks
+        solver.stalled = stalled
+        solver.best_height = best_height
+        solver.budget_used = budget_used
+        solver.done = done
+        solver.contradiction = contradiction
+        return solver
+
+    def stream(self, window = 8, max_restarts = 100):
+        # yields finished rows bottom up, only window rows are kept in memory
+        if window < MIN_WINDOW:
+            raise ValueError(f"window must be at least {MIN_WINDOW} rows")
+        if self.max_retries is None:
+            self.max_retries = 50
+        restarts = self.restarts
+        while not self.done:
+            self.collapse()
+            if self.restarts - restarts > max_restarts:
+                raise RuntimeError(f"no rows fit above row {self.row_offset} after "
+                                   f"{max_restarts} restarts")
+            while self.height > window:
+                yield self.commit_row()
+                restarts = self.restarts
+        for row in self.rows:
+            yield self.row_tiles(row)
+
+    def row_tiles(self, row):
+        # tile index per cell, -1 where no tile fits
+        return [domain.bit_length() - 1 if domain and is_collapsed(domain) else -1
+                for domain in row]
+
+    def tile_grid(self):
+        # rows still in memory, top row first
+        return [self.row_tiles(row) for row in reversed(self.rows)]
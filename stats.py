@@ -0,0 +1,89 @@
+import json
+import time
+
+class Stats:
+
+    # counters bumped by a solver that has it as its stats, and by the live
+    # view, a solver without one only pays an attribute check per propagation
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.propagations = 0
+        self.visited = 0
+        self.touched = 0
+        self.max_touched = 0
+        # propagations by cells touched, in power of two buckets
+        self.touched_buckets = {}
+        # propagations that left a cell without tiles
+        self.contradictions = 0
+        # seconds spent per phase, "collapse" and "draw" in the live view
+        self.times = {}
+
+    def propagated(self, visited, touched, contradiction):
+        self.propagations += 1
+        self.visited += visited
+        self.touched += touched
+        self.max_touched = max(self.max_touched, touched)
+        bucket = touched.bit_length()
+        self.touched_buckets[bucket] = self.touched_buckets.get(bucket, 0) + 1
+        if contradiction:
+            self.contradictions += 1
+
+    def add_time(self, name, seconds):
+        self.times[name] = self.times.get(name, 0) + seconds
+
+    def record(self, snapshot):
+        # totals so far plus the domain sizes of a worker.Snapshot
+        sizes = {}
+        for row in snapshot.rows:
+            for domain in row:
+                size = domain.bit_count()
+                sizes[size] = sizes.get(size, 0) + 1
+        return {
+            "time": time.perf_counter() - self.start,
+            "propagations": self.propagations,
+            "cells_visited": self.visited,
+            "cells_touched": self.touched,
+            "touched_per_propagation": self.touched / max(self.propagations, 1),
+            "max_touched": self.max_touched,
+            # "n": propagations that touched fewer than n + 1 cells
+            "touched_histogram": {str((1 << b) - 1): n
+                                  for b, n in sorted(self.touched_buckets.items())},
+            "contradictions": self.contradictions,
+            "retries": snapshot.retries,
+            "restarts": snapshot.restarts,
+            "backtracks": snapshot.backtracks,
+            "domain_sizes": {str(size): n for size, n in sorted(sizes.items())},
+            "times": dict(self.times)
+        }
+
+    def lines(self, record):
+        # short summary for the on screen overlay
+        times = record["times"]
+        sizes = " ".join(f"{size}:{n}" for size, n in record["domain_sizes"].items())
+        return [
+            f"propagations {record['propagations']}, "
+            f"{record['touched_per_propagation']:.1f} cells each, max {record['max_touched']}",
+            f"contradictions {record['contradictions']}, retries {record['retries']}, "
+            f"restarts {record['restarts']}",
+            f"collapse {times.get('collapse', 0):.2f}s, draw {times.get('draw', 0):.2f}s",
+            f"domains {sizes}"
+        ]
+
+class StatsLog:
+
+    # appends a Stats record to a jsonl file every interval seconds
+    def __init__(self, path, interval = 1.0):
+        self.file = open(path, "a")
+        self.interval = interval
+        self.last = 0
+
+    def update(self, stats, snapshot):
+        now = time.perf_counter()
+        if now - self.last < self.interval:
+            return
+        self.last = now
+        self.file.write(json.dumps(stats.record(snapshot)) + "\n")
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
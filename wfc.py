@@ -1,29 +1,39 @@
 #!/usr/bin/env python3
 
 import sys
+import time
+
+# process start, near enough, for the time to first frame
+START = time.perf_counter()
+
+if __name__ == "__main__" and sys.argv[1:2] == ["generate"]:
+    # headless, doesn't load pygame or anything else the live view needs
+    import generate
+    generate.main(sys.argv[2:])
+    sys.exit()
+
 import pygame
-import json
-import os
 import math
-import random
 import numpy
-import cv2
+from collections import OrderedDict
+from solver import Solver, Tileset, bits
+from worker import SolverWorker
+from stats import Stats, StatsLog
+from atlas import load_tile_images
+from checkpoint import Checkpointer, load_solver, check_path
 
 def usage():
-    print("Usage: ./wfc.py path_to_tile_dir")
+    print("Usage: ./wfc.py path_to_tile_dir [--stats stats.jsonl] [--source image --source-scale n]")
+    print("       ./wfc.py path_to_tile_dir [--video clouds.mp4] [--checkpoint state.bin]")
+    print("       ./wfc.py generate path_to_tile_dir [options]")
+    print(" " * 4, "--stats append solver and draw stats to a jsonl file every second")
+    print(" " * 4, "--source cut tiles from this image, --source-scale times the size of")
+    print(" " * 12, "the original one, instead of drawing the biggest atlas of the set")
+    print(" " * 4, "--video play a video behind the grid, needs opencv")
+    print(" " * 4, "--checkpoint resume from this snapshot and save to it every")
+    print(" " * 12, "--checkpoint-interval seconds (60) and on exit")
     print(" " * 4, "-h print this message and exit")
 
-class Cell:
-
-    def __init__(self):
-        self.domain = set()
-
-    def is_collapsed(self):
-        return len(self.domain) <= 1
-    
-    def is_valid(self):
-        return len(self.domain) > 0
-
 class Interpolator:
 
     def __init__(self):
@@ -54,81 +64,116 @@ class Interpolator:
 
 class Grid:
 
-    def __init__(self, game):
+    def __init__(self, game, resume = True, seed = None, start = True):
+        self.tileset = Tileset.load(game.tile_dir)
+        solver = None
+        if game.checkpoint_path and resume:
+            solver = load_solver(self.tileset, game.checkpoint_path)
+        if solver is None:
+            solver = Solver(self.tileset, seed = seed)
+        solver.max_retries = 50
+        solver.stats = game.stats
         self.game = game
-        self.width = 10
-        self.height = 1
-        self.timer = pygame.time.get_ticks()
-        self.rows = []
+        self.width = solver.width
         self.dy = 0
-        self.search_speed = 300
-        self.num_rows = 0
-        self.backtracking_level = 0
+        # solver steps per second, sped up while backtracking
+        self.steps_per_second = 10 / 3
+        self.backtrack_steps_per_second = 20
         self.graying_start_time = 0
         self.graying_end_time = 0
         self.interp = Interpolator()
-        for _ in range(self.height):
-            self.rows.append([Cell() for _ in range(self.width)])
-        desc_path = os.path.join(game.tile_dir, "tiles.json")
-        with open(desc_path) as file:
-            self.tile_desc = json.load(file)
-        self.domain = set(range(len(self.tile_desc["tiles"])))
-        for row in self.rows:
-            for cell in row:
-                cell.domain = set(self.domain)
-        self.atlas = []
-        # for tile in self.tile_desc["tiles"]:
-        #     img_path = os.path.join(game.tile_dir, tile["image"])
-        #     self.atlas.append(pygame.image.load(img_path))
-        self.img_hq = pygame.image.load("scarf-hq.png")
-        for tile in self.tile_desc["tiles"]:
-            rect = (tile["x"] * 10, tile["y"] * 10, 3 * 10, 3 * 10)
-            img = self.img_hq.subsurface(rect)
-            self.atlas.append(img)
-
-    def new_row(self):
-        row = [Cell() for _ in range(self.width)]
-        for cell in row:
-            cell.domain = set(self.domain)
-        return row
+        # rows below the screen are streamed out, keep a screen full and some
+        win_width, win_height = game.win.get_size()
+        window = math.ceil(win_height / (win_width / self.width)) + 4
+        # the solver runs in its own thread, frames only see its snapshots
+        self.worker = SolverWorker(solver, self.steps_per_second, window)
+        self.worker.backtrack_steps_per_second = self.backtrack_steps_per_second
+        if game.checkpoint_path:
+            self.worker.checkpointer = Checkpointer(game.checkpoint_path,
+                                                    game.checkpoint_interval)
+            self.worker.checkpointer.start()
+        self.backtracking_level = 0
+        # (x, y) to repaint, y counts committed rows
+        self.dirty = set()
+        self.apply(self.worker.snapshot())
+        self.drawn_dy = None
+        self.atlas = load_tile_images(game.tile_dir, self.tileset,
+                                      game.source, game.source_scale)
+        # all tiles as one (tiles, w, h, 3) array for blending previews,
+        # made by the first blend
+        self.atlas_pixels = None
+        # scaled previews by (domain, size), least recently used dropped first
+        self.blend_cache = OrderedDict()
+        self.blend_cache_size = 1024
+        # without start the worker is left for the caller to step
+        if start:
+            self.worker.start()
+
+    def stop(self):
+        self.worker.stop()
+
+    def apply(self, snapshot):
+        level = self.backtracking_level
+        self.snapshot = snapshot
+        self.rows = snapshot.rows
+        self.height = snapshot.height
+        self.row_offset = snapshot.row_offset
+        self.backtracking_level = snapshot.backtracking_level
+        self.dirty.update(snapshot.dirty)
+        if level == 0 and self.backtracking_level > 0:
+            self.graying_start_time = pygame.time.get_ticks()
+        elif level > 0 and self.backtracking_level == 0:
+            self.graying_end_time = pygame.time.get_ticks()
+
+    def collapse(self):
+        self.worker.request_step()
 
     def pad_rect(self, rect):
         return next((x + 20, y + 20, w - 40, h - 40) for x, y, w, h in [rect])
 
-    def blend_images(self, imgs):
-        # img = imgs[0].convert()
-        # for i in range(1, len(imgs)):
-        #     img.blit(imgs[i], (0, 0), special_flags = pygame.BLEND_RGB_MULT)
-        # return img
-        img = imgs[0].convert()
-        alpha = 255 // len(imgs)
-        for i in range(1, len(imgs)):
-            cp = imgs[i].copy()
-            cp.set_alpha(alpha)
-            img.blit(cp, (0, 0))
-        return img
-        # alpha = 255 // len(imgs)
-        # blended = None
-        # for img in imgs:
-        #     cp = img.copy()
-        #     cp.set_alpha(alpha)
-        #     if not blended:
-        #         blended = cp
-        #     else:
-        #         blended.blit(img, (0, 0))
-        # return blended
+    def blend_many(self, domains):
+        # average of every domain's tiles as one matrix product, each row of
+        # weights holds 1 / len(domain) for the tiles in that domain
+        if self.atlas_pixels is None:
+            self.atlas_pixels = numpy.stack([pygame.surfarray.array3d(img)
+                                             for img in self.atlas]).astype(numpy.float32)
+        weights = numpy.zeros((len(domains), self.tileset.count), numpy.float32)
+        for i, domain in enumerate(domains):
+            tiles = list(bits(domain))
+            weights[i, tiles] = 1 / len(tiles)
+        count, w, h, _ = self.atlas_pixels.shape
+        blended = weights @ self.atlas_pixels.reshape(count, -1)
+        blended = blended.reshape(len(domains), w, h, 3).round().astype(numpy.uint8)
+        return [pygame.surfarray.make_surface(pixels) for pixels in blended]
+
+    def prepare_blends(self, domains, size):
+        missing = {domain for domain in domains
+                   if domain and (domain, size) not in self.blend_cache}
+        missing = list(missing)
+        if not missing:
+            return
+        for domain, img in zip(missing, self.blend_many(missing)):
+            img = pygame.transform.scale(img, size).convert()
+            self.blend_cache[(domain, size)] = img
+        while len(self.blend_cache) > self.blend_cache_size:
+            self.blend_cache.popitem(last = False)
+
+    def get_blended(self, domain, size):
+        key = (domain, size)
+        if key not in self.blend_cache:
+            self.prepare_blends([domain], size)
+        self.blend_cache.move_to_end(key)
+        return self.blend_cache[key]
 
     def draw_label(self, x, y, bounds):
         # bounds = self.pad_rect(bounds)
-        cell = self.rows[y][x]
+        domain = self.rows[y][x]
         font = self.game.font
-        dim = math.ceil(math.sqrt(len(cell.domain)))
-        if dim == 0:
+        if not domain:
             return
         # blended image
-        images = [self.atlas[i] for i in cell.domain]
-        img = self.blend_images(images)
-        img = pygame.transform.scale(img, bounds[2:4])
+        size = (round(bounds[2]), round(bounds[3]))
+        img = self.get_blended(domain, size)
         # # cardinality
         # font_surface = font.render(str(len(cell.domain)), True, (255, 0, 255))
         # img.blit(font_surface, (0, 0))
@@ -152,210 +197,169 @@ class Grid:
         #     img = pygame.transform.scale(img, (lsize - 4, lsize - 4))
         #     self.game.win.blit(img, (lx + 2, ly + 2))
 
-    def draw_cell(self, x, y):
-        cell = self.rows[y][x]
+    def cell_rect(self, x, y):
         win_width, win_height = self.game.win.get_size()
         size = win_width / self.width
         abs_x = x * size
-        abs_y = win_height - (y + 1) * size + self.dy
-        rect = (abs_x, abs_y, size, size)
+        abs_y = win_height - (self.row_offset + y + 1) * size + self.dy
+        return (abs_x, abs_y, size, size)
+
+    def draw_cell(self, x, y):
+        rect = self.cell_rect(x, y)
         # pygame.draw.rect(self.game.win, (200, 0, 0), rect)
         self.draw_label(x, y, rect)
 
+    def is_scrolling(self):
+        return not self.interp.done or self.dy != self.drawn_dy
+
+    def draw_dirty(self):
+        # repaint only cells whose domain changed, returns the rects touched
+        rects = []
+        dirty = self.dirty
+        self.dirty = set()
+        for x, y in dirty:
+            y -= self.row_offset
+            if y < 0:
+                continue
+            rect = pygame.Rect(self.cell_rect(x, y))
+            if not rect.colliderect(self.game.win.get_rect()):
+                continue
+            self.game.win.fill((0, 0, 0), rect)
+            if y < self.height:
+                self.draw_label(x, y, rect)
+            rects.append(rect)
+        return rects
+
     def draw(self):
         win_width, win_height = self.game.win.get_size()
         size = win_width / self.width
-        top = win_height - (self.height) * size + self.dy
-        if top < 400 and self.interp.done:
-            self.interp.restart(self.dy, self.dy + abs(top) + 50)
-        first_y = math.floor(self.dy / size)
+        self.dirty = set()
+        self.drawn_dy = self.dy
+        first_y = max(math.floor(self.dy / size) - self.row_offset, 0)
         # print(f"first y {first_y}")
+        # blend every preview missing from the cache in one go
+        domains = [domain for row in self.rows[first_y:] for domain in row]
+        self.prepare_blends(domains, (round(size), round(size)))
         for y in range(first_y, self.height):
             for x in range(0, self.width):
                 self.draw_cell(x, y)
 
-    def pick_cell(self):
-        cells = []
-        for y in range(self.height):
-            for x in range(self.width):
-                cell = self.rows[y][x]
-                if cell.is_collapsed():
-                    continue
-                cells.append((x, y, cell))
-        if len(cells) == 0:
-            return (0, 0, None)
-        lowest = min([len(cell.domain) for (x, y, cell) in cells])
-        cells = [(x, y, cell) for (x, y, cell) in cells
-                 if len(cell.domain) == lowest]
-        return random.choice(cells)
-    
-    def get_constraint(self, tile_num, name):
-        return set(self.tile_desc["tiles"][tile_num]["constraints"][name])
-
-    def propagate_v2(self):
-        changed = False
-        for y in range(self.height):
-            for x in range(self.width):
-                cell = self.rows[y][x]
-                if cell.is_collapsed() or not cell.is_valid():
-                    continue
-                old_size = len(cell.domain)
-                domain = set(self.domain)
-                if x > 0:
-                    left_cell = self.rows[y][x - 1]
-                    right = set()
-                    for v in left_cell.domain:
-                        right = right.union(self.get_constraint(v, "right"))
-                    domain = domain.intersection(right)
-                if x < self.width - 1:
-                    right_cell = self.rows[y][x + 1]
-                    left = set()
-                    for v in right_cell.domain:
-                        left = left.union(self.get_constraint(v, "left"))
-                    domain = domain.intersection(left)
-                if y > 0:
-                    down_cell = self.rows[y - 1][x]
-                    up = set()
-                    for v in down_cell.domain:
-                        up = up.union(self.get_constraint(v, "up"))
-                    domain = domain.intersection(up)
-                if y < self.height - 1:
-                    up_cell = self.rows[y + 1][x]
-                    down = set()
-                    for v in up_cell.domain:
-                        down = down.union(self.get_constraint(v, "down"))
-                    domain = domain.intersection(down)
-                cell.domain = domain
-                if old_size != len(domain):
-                    changed = True
-        if changed:
-            self.propagate_v2()
-
-    def propagate(self):
-        self.propagate_v2()
-        return
-        todo = []
-        for y in range(self.height):
-            for x in range(self.width):
-                cell = self.rows[y][x]
-                if cell.is_collapsed() and cell.is_valid():
-                    todo.append((x, y, cell))
-        for x, y, cell in todo:
-            value = list(cell.domain)[0]
-            tile_info = self.tile_desc["tiles"][value]
-            constraints = tile_info["constraints"]
-            left = set(constraints["left"])
-            right = set(constraints["right"])
-            up = set(constraints["up"])
-            down = set(constraints["down"])
-            changed = False
-            if x > 0:
-                left_cell = self.rows[y][x - 1]
-                old_size = len(left_cell.domain)
-                left_cell.domain = left_cell.domain.intersection(left)
-                if old_size != len(left_cell.domain):
-                    self.propagate()
-                    return
-            if x < self.width - 1:
-                right_cell = self.rows[y][x + 1]
-                old_size = len(right_cell.domain)
-                right_cell.domain = right_cell.domain.intersection(right)
-                if old_size != len(right_cell.domain):
-                    self.propagate()
-                    return
-            if y < self.height - 1:
-                up_cell = self.rows[y + 1][x]
-                old_size = len(up_cell.domain)
-                up_cell.domain = up_cell.domain.intersection(up)
-                if old_size != len(up_cell.domain):
-                    self.propagate()
-                    return
-            if y > 0:
-                down_cell = self.rows[y - 1][x]
-                old_size = len(down_cell.domain)
-                down_cell.domain = down_cell.domain.intersection(down)
-                if old_size != len(down_cell.domain):
-                    self.propagate()
-                    return
-    
-    def collapse(self):
-        x, y, cell = self.pick_cell()
-        if not cell:
-            print("nothing to collapse!")
-            last_row = self.rows[-1]
-            for cell in last_row:
-                if not cell.is_valid():
-                    print("retrying last row!")
-                    if self.num_rows == len(self.rows) and self.backtracking_level < 3:
-                        print("row failed twice, backtracking!")
-                        self.rows.pop()
-                        self.height -= 1
-                        if self.backtracking_level == 0:
-                            self.graying_start_time = pygame.time.get_ticks()
-                            self.search_speed = 50
-                        self.backtracking_level += 1
-                    self.num_rows = len(self.rows)
-                    self.rows[-1] = self.new_row()
-                    return
-            if self.backtracking_level == 1:
-                self.graying_end_time = pygame.time.get_ticks()
-                self.search_speed = 300
-            self.backtracking_level = max(self.backtracking_level - 1, 0)
-            self.rows.append(self.new_row())
-            self.height += 1
-            self.propagate()
-            return
-        v = random.choice(list(cell.domain))
-        # print(f"collapsing {x}, {y}, ({len(cell.domain)}) to {v}")
-        cell.domain = set([v])
-        self.propagate()
-
     def update(self, delta):
+        # whatever the solver finished since the last frame
+        for snapshot in self.worker.take_snapshots():
+            self.apply(snapshot)
         self.interp.update()
         self.dy = self.interp.value
-        now = pygame.time.get_ticks()
-        if now - self.timer > self.search_speed:
-            self.collapse()
-            # process = psutil.Process()
-            # print(f"{process.memory_info().rss / 1000000} MB")
-            self.timer = pygame.time.get_ticks()
+        win_width, win_height = self.game.win.get_size()
+        size = win_width / self.width
+        top = win_height - (self.row_offset + self.height) * size + self.dy
+        if top < 400 and self.interp.done:
+            self.interp.restart(self.dy, self.dy + abs(top) + 50)
+        # process = psutil.Process()
+        # print(f"{process.memory_info().rss / 1000000} MB")
 
 class MyGame:
 
-    def __init__(self, tile_dir):
+    def __init__(self, tile_dir, stats_path = None, source = None, source_scale = 1,
+                 video_path = None, checkpoint_path = None, checkpoint_interval = 60):
         self.tile_dir = tile_dir
+        # tiles are cut from this image instead of the set's atlas
+        self.source = source
+        self.source_scale = source_scale
+        # a video behind the grid, opencv is only imported when there is one
+        self.video_path = video_path
+        self.video = None
+        self.cv2 = None
+        # the solver is resumed from and saved to this snapshot
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint_interval = checkpoint_interval
         self.pause = False
+        # collected only when logged or shown, the overlay turns it on
+        self.stats = Stats() if stats_path else None
+        self.stats_log = StatsLog(stats_path) if stats_path else None
+        self.show_stats = False
+        # repaint everything next frame instead of only what changed
+        self.full_redraw = True
+        self.gray_buffers = None
 
     def draw(self, delta):
+        # returns the rects that changed, None when the whole window did,
+        # which it always does behind a video
+        if not self.full_redraw and not self.video and not self.grid.is_scrolling():
+            return self.grid.draw_dirty()
+        self.full_redraw = False
         self.win.fill((0, 0, 0))
-        # success, video_image = self.video.read()
-        # if not success:
-        #     print("failed video read, looping")
-        #     self.video.set(cv2.CAP_PROP_POS_FRAMES, 0)
-        #     success, video_image = self.video.read()
-        # if success:
-        #     # avg_5x5 = numpy.ones((5, 5), numpy.float32) / 25.0
-        #     # video_image = cv2.filter2D(video_image, -1, avg_5x5)
-        #     surf = pygame.image.frombuffer(video_image.tobytes(), 
-        #                                    video_image.shape[1::-1], "BGR")
-        #     vw, vh = surf.get_size()
-        #     ww, wh = self.win.get_size()
-        #     self.win.blit(surf, (ww - vw, 0))
+        if self.video:
+            self.draw_video()
         self.grid.draw()
+        return None
+
+    def open_video(self):
+        # https://stackoverflow.com/a/69054207
+        import cv2
+        self.cv2 = cv2
+        self.video = cv2.VideoCapture(self.video_path)
+
+    def draw_video(self):
+        success, video_image = self.video.read()
+        if not success:
+            print("failed video read, looping")
+            self.video.set(self.cv2.CAP_PROP_POS_FRAMES, 0)
+            success, video_image = self.video.read()
+        if success:
+            # avg_5x5 = numpy.ones((5, 5), numpy.float32) / 25.0
+            # video_image = cv2.filter2D(video_image, -1, avg_5x5)
+            surf = pygame.image.frombuffer(video_image.tobytes(),
+                                           video_image.shape[1::-1], "BGR")
+            vw, vh = surf.get_size()
+            ww, wh = self.win.get_size()
+            self.win.blit(surf, (ww - vw, 0))
 
     def collapse(self):
         self.grid.collapse()
 
+    def toggle_stats(self):
+        self.show_stats = not self.show_stats
+        if self.stats is None:
+            self.stats = Stats()
+            self.grid.worker.solver.stats = self.stats
+
+    def draw_stats(self):
+        lines = self.stats.lines(self.stats.record(self.grid.snapshot))
+        for i, line in enumerate(lines):
+            font_surface = self.font.render(line, True, (230, 230, 230), (0, 0, 0))
+            self.win.blit(font_surface, (4, 4 + i * 20))
+
     def update(self, delta):
         self.grid.update(delta)
 
-    # https://stackoverflow.com/a/65919555
-    def convert_to_grayscale(self, surface: pygame.Surface):
-        arr = pygame.surfarray.pixels3d(surface)
-        mean_arr = numpy.dot(arr[:,:,:], [0.216, 0.587, 0.144])
-        mean_arr3d = mean_arr[..., numpy.newaxis]
-        new_arr = numpy.repeat(mean_arr3d[:, :, :], 3, axis=2)
-        return pygame.surfarray.make_surface(new_arr)
+    def fade_to_gray(self, surface, amount):
+        # blends the surface towards grayscale in place, 0 keeps the colors
+        # and 1 is fully gray, integer math in buffers reused every frame
+        k = round(amount * 256)
+        if k <= 0:
+            return
+        pixels = pygame.surfarray.pixels3d(surface)
+        shape = pixels.shape[:2]
+        if self.gray_buffers is None or self.gray_buffers[0].shape != shape:
+            self.gray_buffers = (numpy.empty(shape, numpy.int32),
+                                 numpy.empty(shape, numpy.int32))
+        gray, tmp = self.gray_buffers
+        # https://stackoverflow.com/a/65919555 weights, times 256
+        numpy.multiply(pixels[..., 0], 55, out = gray, dtype = numpy.int32)
+        numpy.multiply(pixels[..., 1], 150, out = tmp, dtype = numpy.int32)
+        gray += tmp
+        numpy.multiply(pixels[..., 2], 37, out = tmp, dtype = numpy.int32)
+        gray += tmp
+        gray >>= 8
+        for c in range(3):
+            channel = pixels[..., c]
+            numpy.subtract(gray, channel, out = tmp, dtype = numpy.int32)
+            tmp *= k
+            tmp >>= 8
+            tmp += channel
+            numpy.copyto(channel, tmp, casting = "unsafe")
+        del pixels
 
     def run(self):
         pygame.init()
@@ -367,10 +371,10 @@ class MyGame:
         running = True
         self.grid = Grid(self)
         self.grayscale = False
-        # https://stackoverflow.com/a/69054207
-        self.video = cv2.VideoCapture("clouds.mp4")
+        if self.video_path:
+            self.open_video()
         self.rotate_left = False
-        success, video_image = self.video.read()
+        first_frame = True
         while running:
             delta = clock.tick(60) / 1000
             for e in pygame.event.get():
@@ -383,56 +387,104 @@ class MyGame:
                         self.collapse()
                     elif e.key == pygame.K_p:
                         self.pause = not self.pause
+                        self.grid.worker.paused = self.pause
                     elif e.key == pygame.K_r:
-                        self.grid = Grid(self)
+                        self.grid.stop()
+                        self.grid = Grid(self, resume = False)
+                        self.grid.worker.paused = self.pause
                     elif e.key == pygame.K_g:
                         self.grayscale = not self.grayscale
                     elif e.key == pygame.K_f:
                         self.base_win = pygame.display.set_mode((0, 0), pygame.FULLSCREEN)
                     elif e.key == pygame.K_l:
                         self.rotate_left = not self.rotate_left
+                    elif e.key == pygame.K_s:
+                        self.toggle_stats()
+                    self.full_redraw = True
+            rects = []
             if not self.pause:
                 self.update(delta)
-                self.draw(delta)
+                start = time.perf_counter()
+                rects = self.draw(delta)
+                if self.stats is not None:
+                    self.stats.add_time("draw", time.perf_counter() - start)
+            fading = pygame.time.get_ticks() - self.grid.graying_end_time < 1000
+            if self.grid.backtracking_level > 0 or fading or self.grayscale:
+                # effects work on the whole window, so does the next frame
+                rects = None
+                self.full_redraw = True
             if self.grid.backtracking_level > 0:
                 delta = pygame.time.get_ticks() - self.grid.graying_start_time
                 f = min(delta / 3000, 1.0)
-                gray = self.convert_to_grayscale(self.win)
-                a = pygame.surfarray.array3d(self.win)
-                b = pygame.surfarray.array3d(gray)
-                fade = a * (1 - f) + b * f
-                self.win.blit(pygame.surfarray.make_surface(fade), (0, 0))
+                self.fade_to_gray(self.win, f)
             else:
                 delta = pygame.time.get_ticks() - self.grid.graying_end_time
                 f = min(delta / 1000, 1.0)
                 if f < 1.0:
-                    gray = self.convert_to_grayscale(self.win)
-                    a = pygame.surfarray.array3d(self.win)
-                    b = pygame.surfarray.array3d(gray)
-                    fade = a * f + b * (1 - f)
-                    self.win.blit(pygame.surfarray.make_surface(fade), (0, 0))
+                    self.fade_to_gray(self.win, 1 - f)
             if self.grayscale:
-                # img_array = pygame.surfarray.array3d(self.win.convert())
                 # gray = numpy.dot(img_array[...,:3], [0.2989, 0.5870, 0.1140])
-                gray = self.convert_to_grayscale(self.win)
-                self.win.blit(gray, (0, 0))
+                self.fade_to_gray(self.win, 1)
+            if self.show_stats:
+                # the overlay changes every frame, cells below it too
+                self.draw_stats()
+                rects = None
+                self.full_redraw = True
+            if self.stats_log:
+                self.stats_log.update(self.stats, self.grid.snapshot)
             win = self.win
             if self.rotate_left:
                 win = pygame.transform.rotate(win, 90)
             bw, bh = self.base_win.get_size()
             ww, wh = win.get_size()
-            self.base_win.fill((0, 0, 0))
-            self.base_win.blit(win, ((bw - ww) / 2, (bh - wh) / 2))
-            pygame.display.flip()
+            left = (bw - ww) // 2
+            top = (bh - wh) // 2
+            if rects is None or self.rotate_left:
+                self.base_win.fill((0, 0, 0))
+                self.base_win.blit(win, (left, top))
+                pygame.display.flip()
+            elif rects:
+                rects = [rect.clip(win.get_rect()) for rect in rects]
+                for rect in rects:
+                    self.base_win.blit(win, (left + rect.x, top + rect.y), rect)
+                pygame.display.update([rect.move(left, top) for rect in rects])
+            if first_frame:
+                first_frame = False
+                print(f"First frame after {time.perf_counter() - START:.3f}s", flush = True)
+        self.grid.stop()
+        if self.stats_log:
+            self.stats_log.close()
+        if self.video:
+            self.video.release()
         pygame.quit()
 
+def option(name, default = None):
+    # value after name on the command line
+    if name not in sys.argv:
+        return default
+    i = sys.argv.index(name)
+    if i + 1 >= len(sys.argv):
+        usage()
+        sys.exit(f"*** expected a value after {name}")
+    return sys.argv[i + 1]
+
 def main():
     tile_dir = sys.argv[1] if len(sys.argv) > 1 else None
     if not tile_dir or "-h" in sys.argv:
         usage()
         sys.exit("*** path to tile directory not specified")
+    stats_path = option("--stats")
+    source = option("--source")
+    source_scale = int(option("--source-scale", 1))
+    video_path = option("--video")
+    checkpoint_path = option("--checkpoint")
+    checkpoint_interval = float(option("--checkpoint-interval", 60))
+    if checkpoint_path and check_path(checkpoint_path):
+        usage()
+        sys.exit(f"*** {check_path(checkpoint_path)}")
     print(f"Tile directory {tile_dir}")
-    game = MyGame(tile_dir)
+    game = MyGame(tile_dir, stats_path, source, source_scale, video_path, checkpoint_path,
+                  checkpoint_interval)
     game.run()
 
 if __name__ == "__main__":
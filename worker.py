@@ -0,0 +1,114 @@
+import time
+import queue
+import threading
+from solver import MIN_WINDOW
+
+class Snapshot:
+
+    # the solver after a step, rows are copied so it can be read from
+    # another thread while the solver moves on
+    def __init__(self, solver, dirty = ()):
+        self.width = solver.width
+        self.height = solver.height
+        self.row_offset = solver.row_offset
+        self.rows = tuple(tuple(row) for row in solver.rows)
+        self.backtracking_level = solver.backtracking_level
+        self.done = solver.done
+        self.retries = solver.retries
+        self.restarts = solver.restarts
+        self.backtracks = solver.backtracks
+        # (x, y) changed since the previous snapshot, y counts committed rows
+        self.dirty = frozenset(dirty)
+
+class SolverWorker(threading.Thread):
+
+    # steps a solver in the background and publishes a Snapshot after every
+    # step, nothing else may touch the solver once the worker is started
+    def __init__(self, solver, steps_per_second = None, window = None):
+        super().__init__(daemon = True)
+        self.solver = solver
+        # None steps as fast as the snapshots are taken
+        self.steps_per_second = steps_per_second
+        self.backtrack_steps_per_second = steps_per_second
+        # rows kept before the bottom one is committed, None keeps all
+        if window is not None and window < MIN_WINDOW:
+            raise ValueError(f"window must be at least {MIN_WINDOW} rows")
+        self.window = window
+        self.paused = False
+        self.running = True
+        self.steps = 0
+        # a checkpoint.Checkpointer saving the solver between steps
+        self.checkpointer = None
+        self.requests = queue.Queue()
+        self.snapshots = queue.Queue(maxsize = 64)
+        solver.track_dirty()
+
+    def snapshot(self):
+        offset = self.solver.row_offset
+        dirty = {(x, y + offset) for x, y in self.solver.take_dirty()}
+        return Snapshot(self.solver, dirty)
+
+    def step_interval(self):
+        if self.solver.backtracking_level > 0:
+            steps_per_second = self.backtrack_steps_per_second
+        else:
+            steps_per_second = self.steps_per_second
+        return 1 / steps_per_second if steps_per_second else 0
+
+    def step(self):
+        stats = self.solver.stats
+        start = time.perf_counter()
+        self.solver.collapse()
+        if self.window:
+            while self.solver.height > self.window:
+                self.solver.commit_row()
+        if stats is not None:
+            stats.add_time("collapse", time.perf_counter() - start)
+        if self.checkpointer:
+            self.checkpointer.update(self.solver)
+        self.steps += 1
+        self.publish(self.snapshot())
+
+    def publish(self, snapshot):
+        # blocks while the reader is behind, so memory stays bounded
+        while self.running:
+            try:
+                self.snapshots.put(snapshot, timeout = 0.1)
+                return
+            except queue.Full:
+                pass
+
+    def request_step(self):
+        # one step right away, even when paused
+        self.requests.put(True)
+
+    def take_snapshots(self):
+        snapshots = []
+        while True:
+            try:
+                snapshots.append(self.snapshots.get_nowait())
+            except queue.Empty:
+                return snapshots
+
+    def run(self):
+        next_step = time.perf_counter()
+        while self.running:
+            timeout = 0.1 if self.paused else next_step - time.perf_counter()
+            try:
+                self.requests.get(timeout = max(timeout, 0))
+            except queue.Empty:
+                if self.paused or time.perf_counter() < next_step:
+                    continue
+                next_step = max(next_step + self.step_interval(), time.perf_counter())
+            if self.running:
+                self.step()
+
+    def stop(self):
+        self.running = False
+        # wakes the thread up if it is waiting for the next step
+        self.requests.put(True)
+        self.join()
+        if self.checkpointer:
+            # the solver is ours again, save where it stopped
+            self.checkpointer.save(self.solver)
+            self.checkpointer.stop()